@@ -1,19 +1,32 @@
+import io
+import json
 import os
+import pstats
+import threading
+import time
+import uuid
 try:
     import pandas as pd
     import numpy as np
-    from flask import Flask, render_template, request, redirect, url_for, send_file, flash
-    import anjana.anonymity as anonymity
-    from anjana.anonymity import utils
+    from flask import Flask, render_template, request, redirect, url_for, send_file, flash, jsonify, g, Response, stream_with_context
 except ImportError as e:
     print(f"{e}. Installing missing packages...")
-    import os
     os.system("pip install pandas numpy flask anjana")  # Install required libraries
     import pandas as pd
     import numpy as np
-    from flask import Flask, render_template, request, redirect, url_for, send_file, flash
-    import anjana.anonymity as anonymity
-    from anjana.anonymity import utils
+    from flask import Flask, render_template, request, redirect, url_for, send_file, flash, jsonify, g, Response, stream_with_context
+
+import hierarchy_builders
+from dataset_cache import DatasetCache, DatasetProfile, DEFAULT_MEMORY_BUDGET, DEFAULT_STREAMING_THRESHOLD
+from equivalence_index import EquivalenceIndex
+from hierarchy_registry import HierarchyRegistry, MappingHierarchy
+from jobs import FINISHED_STATES, JobManager, QueueFull
+from result_cache import DEFAULT_MAX_BYTES, ResultCache, is_key, result_key
+import columnar
+import ingest
+import instrumentation
+import pipeline
+import result_files
 
 # import pandas as pd
 # import numpy as np
@@ -26,8 +39,166 @@ app = Flask(__name__)
 # Folders for storing uploaded and processed files
 UPLOAD_FOLDER = 'uploads'
 PROCESSED_FOLDER = 'processed'
+# Results of the web application, stored by input content and settings
+RESULT_FOLDER = os.path.join(PROCESSED_FOLDER, 'results')
+# Columnar (Parquet) copies of the uploads
+COLUMNAR_FOLDER = 'columnar'
+# Folder with the named hierarchy definitions (ARX-style CSV or JSON)
+HIERARCHY_FOLDER = 'hierarchies'
+# Largest page of rows served by the paginated result preview
+MAX_PREVIEW_ROWS = 1000
+# cProfile stats of the jobs run with profiling enabled
+PROFILE_FOLDER = 'profiles'
+# Disk space kept for them (256 MB by default); the oldest are removed first
+PROFILE_FOLDER_BYTES = int(os.environ.get('PROFILE_FOLDER_BYTES', 256 * 1024 * 1024))
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(PROCESSED_FOLDER, exist_ok=True)
+os.makedirs(COLUMNAR_FOLDER, exist_ok=True)
+
+# Profile every job, not only those submitted with profile=1
+PROFILE_ALL_JOBS = os.environ.get('ANONYMIZATION_PROFILE', '') == '1'
+
+instrumentation.configure_logging()
+
+# Parsed uploads shared across requests
+dataset_cache = DatasetCache(
+    memory_budget=int(os.environ.get('DATASET_CACHE_BYTES', DEFAULT_MEMORY_BUDGET)),
+    streaming_threshold=int(os.environ.get('STREAMING_INGEST_BYTES', DEFAULT_STREAMING_THRESHOLD)),
+    columnar_folder=COLUMNAR_FOLDER
+)
+
+# Anonymized results shared by every request with the same data and settings
+result_cache = ResultCache(RESULT_FOLDER, max_bytes=int(os.environ.get('RESULT_CACHE_BYTES', DEFAULT_MAX_BYTES)))
+# Result key -> id of the job producing it, so identical requests share one job
+pending_results = {}
+pending_lock = threading.Lock()
+
+# Named hierarchies, compiled once at startup
+hierarchy_registry = HierarchyRegistry()
+hierarchy_registry.load_folder(HIERARCHY_FOLDER)
+
+def record_job_metrics(job):
+    """
+    Add a finished job, and the stage spans its worker sent back, to the metrics.
+    """
+    metrics = instrumentation.metrics
+    metrics.inc('anonymizer_jobs_total', 'Anonymization jobs by final status.', status=job.status)
+    if job.started is not None:
+        metrics.observe('anonymizer_job_queue_seconds', 'Time jobs waited for a worker.',
+                        job.started - job.created)
+        metrics.observe('anonymizer_job_run_seconds', 'Time jobs ran on a worker.',
+                        job.finished - job.started, status=job.status)
+    if job.status == 'done':
+        for record in job.result.get('spans', []):
+            instrumentation.record_span({**record, 'process': 'worker'})
+        instrumentation.logger.info(json.dumps({
+            'event': 'job', 'job_id': job.id, 'description': job.description,
+            'seconds': job.finished - job.created, 'spans': job.result.get('spans', []),
+        }, default=str))
+
+def store_job_result(job):
+    """
+    Commit the result of a finished job to the result cache.
+    """
+    key = job.context.get('result_key')
+    if key is None:
+        return
+    if job.status == 'done':
+        result_cache.commit(key, {
+            'rows': job.result['rows'],
+            'preview_html': job.result['preview_html'],
+            'created': job.finished,
+        })
+    with pending_lock:
+        if pending_results.get(key) == job.id:
+            del pending_results[key]
+
+def prune_profiles():
+    """
+    Remove the oldest profiles until the folder fits in PROFILE_FOLDER_BYTES.
+    """
+    if not os.path.isdir(PROFILE_FOLDER):
+        return
+    profiles = []
+    for name in os.listdir(PROFILE_FOLDER):
+        path = os.path.join(PROFILE_FOLDER, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        profiles.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in profiles)
+    for _, size, path in sorted(profiles):
+        if total <= PROFILE_FOLDER_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def job_finished(job):
+    record_job_metrics(job)
+    store_job_result(job)
+    prune_profiles()
+
+# Anonymization runs on a process pool with a bounded queue
+job_manager = JobManager(
+    max_workers=int(os.environ.get('ANONYMIZATION_WORKERS', 0)) or None,
+    max_pending=int(os.environ.get('ANONYMIZATION_QUEUE_SIZE', 8)),
+    on_finish=job_finished
+)
+
+@app.before_request
+def start_request_instrumentation():
+    g.request_id = uuid.uuid4().hex
+    g.request_start = time.perf_counter()
+    g.spans_token = instrumentation.start_request_spans()
+
+@app.after_request
+def tag_response(response):
+    g.response_status = response.status_code
+    response.headers['X-Request-ID'] = g.request_id
+    return response
+
+@app.teardown_request
+def finish_request_instrumentation(error=None):
+    """
+    Record the duration of the request and log it with its stage spans.
+    Runs after every request, including those failing with an exception
+    (recorded with status 500).
+    """
+    if 'spans_token' not in g:
+        return
+    spans = instrumentation.finish_request_spans(g.spans_token)
+    seconds = time.perf_counter() - g.request_start
+    status = 500 if error is not None else g.get('response_status', 500)
+    endpoint = request.endpoint or 'unknown'
+    if endpoint != 'metrics':
+        instrumentation.metrics.observe(
+            'anonymizer_http_request_duration_seconds', 'Duration of HTTP requests.', seconds,
+            endpoint=endpoint, method=request.method, status=status
+        )
+        record = {
+            'event': 'request', 'request_id': g.request_id, 'endpoint': endpoint,
+            'method': request.method, 'status': status, 'seconds': seconds, 'spans': spans,
+        }
+        if error is not None:
+            record['error'] = f"{type(error).__name__}: {error}"
+        instrumentation.logger.info(json.dumps(record, default=str))
+
+@app.route('/metrics')
+def metrics():
+    """
+    Stage, request and job metrics in the Prometheus text format.
+    """
+    body = instrumentation.metrics.render(extra_gauges=[
+        ('anonymizer_jobs_active', 'Anonymization jobs queued or running.', job_manager.active_count()),
+        ('anonymizer_dataset_cache_bytes', 'Memory used by cached datasets.', dataset_cache.total_bytes),
+        ('anonymizer_result_cache_bytes', 'Disk space used by stored results.', result_cache.total_bytes),
+        ('anonymizer_process_peak_rss_bytes', 'Peak RSS of the web process.', instrumentation.peak_rss() or 0),
+    ])
+    return Response(body, mimetype='text/plain; version=0.0.4')
 
 def generate_intervals(values, interval):
     """
@@ -60,15 +231,21 @@ def upload_file():
             return redirect(request.url)
         
         filepath = os.path.join(UPLOAD_FOLDER, file.filename)
-        file.save(filepath)
+        with instrumentation.span('save_upload') as record:
+            digest = ingest.save_upload(file, filepath)
+            record['bytes'] = os.path.getsize(filepath)
+        dataset_cache.remember_hash(filepath, digest)
         
         try:
-            df = pd.read_csv(filepath)
+            if os.path.getsize(filepath) > dataset_cache.streaming_threshold:
+                # Large files: only parse the rows shown in the preview
+                preview_html = ingest.read_preview(filepath).to_html(classes="table table-striped", index=False)
+            else:
+                preview_html = dataset_cache.get(filepath).preview_html
         except Exception as e:
             flash("Error reading CSV: " + str(e))
             return redirect(request.url)
         
-        preview_html = df.head(100).to_html(classes="table table-striped", index=False)
         return render_template('upload_preview.html', filename=file.filename, preview=preview_html)
     
     return render_template('upload.html')
@@ -79,6 +256,10 @@ def select_columns():
     Allows the user to assign roles to columns, pick the anonymization method (k-anonymity or l-diversity),
     choose k, suppression level (supp_level), (and l if l-diversity is selected), and define hierarchy types (none, masking, interval)
     for quasi or sensitive columns.
+
+    With action=preview in the form, nothing is anonymized: the response is
+    the JSON plan of the run (hierarchy level per quasi-identifier,
+    suppressed records), computed from the cached equivalence-class index.
     """
     filename = request.args.get('filename')
     if not filename:
@@ -87,28 +268,34 @@ def select_columns():
     
     filepath = os.path.join(UPLOAD_FOLDER, filename)
     try:
-        df = pd.read_csv(filepath)
+        # Column profile and preview only; large files are not fully loaded here
+        profile = dataset_cache.profile(filepath)
     except Exception as e:
         flash("Error reading CSV: " + str(e))
         return redirect(url_for('upload_file'))
     
-    columns = df.columns.tolist()
+    columns = profile.columns
     
-    # Determine column types (for our purposes, we use pandas detection)
-    col_types = {}
-    for col in columns:
-        if pd.api.types.is_numeric_dtype(df[col]):
-            col_types[col] = "numeric"
-        else:
-            col_types[col] = "string"
+    def render_form(status=200):
+        return render_template(
+            'select_columns.html',
+            columns=columns,
+            col_types=profile.col_types,
+            max_len_map=profile.max_len_map,
+            distinct_map=profile.distinct_map,
+            original_preview=profile.preview_html,
+            hierarchy_names=hierarchy_registry.names()
+        ), status
     
-    # Compute maximum string length for each column using the string representation.
-    # This is done for every column so that masking works even for numeric columns.
-    max_len_map = {}
-    for col in columns:
-        max_len_map[col] = df[col].astype(str).apply(len).max()
+    preview = request.form.get('action') == 'preview'
     
-    original_preview = df.head(100).to_html(classes="table table-striped", index=False)
+    def form_error(message, redirect_back=False):
+        if preview or wants_json():
+            return jsonify(error=message), 400
+        flash(message)
+        if redirect_back:
+            return redirect(url_for('select_columns', filename=filename))
+        return render_form()
     
     if request.method == 'POST':
         # Collect roles for each column
@@ -119,53 +306,41 @@ def select_columns():
                 roles[col] = role
         
         if not roles:
-            flash("Please select a role for at least one column!")
-            return render_template(
-                'select_columns.html',
-                columns=columns,
-                col_types=col_types,
-                max_len_map=max_len_map,
-                original_preview=original_preview
-            )
+            return form_error("Please select a role for at least one column!")
         
         # Get the anonymization method (default to k-anonymity)
         method = request.form.get("method", "k_anonymity")
         
+        # anjana itself or the built-in engine giving the same result
+        engine = request.form.get("engine", pipeline.DEFAULT_ENGINE)
+        if engine not in pipeline.ENGINES:
+            return form_error(f"Unknown anonymization engine: {engine}")
+        
         # Get k and suppression level values
         try:
             k_value = int(request.form.get("k", "3"))
             supp_level_value = int(request.form.get("supp_level", "0"))
         except (TypeError, ValueError):
-            flash("Invalid k or suppression level. Please enter valid integers.")
-            return render_template(
-                'select_columns.html',
-                columns=columns,
-                col_types=col_types,
-                max_len_map=max_len_map,
-                original_preview=original_preview
-            )
+            return form_error("Invalid k or suppression level. Please enter valid integers.")
         
         # If l-diversity is selected, get the l value.
         if method == "l_diversity":
             try:
                 l_div = int(request.form.get("l_div", "2"))
             except (TypeError, ValueError):
-                flash("Invalid l value for l-diversity. Please enter a valid integer.")
-                return render_template(
-                    'select_columns.html',
-                    columns=columns,
-                    col_types=col_types,
-                    max_len_map=max_len_map,
-                    original_preview=original_preview
-                )
+                return form_error("Invalid l value for l-diversity. Please enter a valid integer.")
         
         # Build role-based lists
         quasi_ident = [col for col, r in roles.items() if r == 'quasi']
         ident = [col for col, r in roles.items() if r == 'ident']
         sens_att_list = [col for col, r in roles.items() if r == 'sensitive']
         
-                # Build dynamic hierarchies based on user input.
-        hierarchies = {}
+        # Hierarchy of every quasi-identifier and sensitive column, as the
+        # specs of pipeline.build_hierarchies: the data is only loaded here
+        # for previews, anonymization jobs load it and build them in the worker.
+        specs = {}
+        # Cache key of every hierarchy, identifying it in the result and equivalence-class index keys
+        hierarchy_keys = {}
         for i, col in enumerate(columns):
             if col in roles and roles[col] in ['quasi', 'sensitive']:
                 hier_type_field = f"hier_type_{i}"
@@ -174,31 +349,11 @@ def select_columns():
                 chosen_level = request.form.get(hier_level_field, "none")
                                           
                 if chosen_type == "masking":
-
-                    df[col] = df[col].astype(str)
-                    df[col] = df[col].str.strip()
-                    length = df[col].str.len()
-                    if length.nunique() != 1:                
-                        flash('All values of the attritube needs to be of same size in order to do masking')
-                        return redirect(url_for('select_columns', filename=filename))
-                
-
-                    # convert it to string compulsory
-                    try:
-                        mask_level = len(df[col][0]) #int(chosen_level)
-                    except:
-                        mask_level = 0
-                    hierarchy_dict = {0: df[col].values}
-                    for lvl in range(1, mask_level + 1):
-                        def mask_num(n, lvl=lvl):
-                            # if isinstance(n,str):
-                            #     s = n 
-                            # else: #for decimal
-                            #     s = str(int(n))
-                            s = n
-                            return s[:-lvl] + ("*" * lvl) if len(s) > lvl else "*" * lvl
-                        hierarchy_dict[lvl] = df[col].astype(str).apply(mask_num).values
-                    hierarchies[col] = hierarchy_dict
+                    # Values of different lengths are masked from their end
+                    # (right) or lined up on their first character (left)
+                    align = chosen_level if chosen_level in hierarchy_builders.MASKING_ALIGNMENTS else "right"
+                    specs[col] = {'type': 'masking', 'align': align}
+                    hierarchy_keys[col] = ('masking', col, align)
                 # elif chosen_type == "interval":
                 #     try:
                 #         interval_val = int(chosen_level)
@@ -213,211 +368,328 @@ def select_columns():
                 elif chosen_type == "custom":
                     custom_text = request.form.get(f"custom_hier_{i}")
                     if custom_text:
-                        custom_map = {}
-                        lines = custom_text.splitlines()
-                        for line in lines:
-                            if line.strip():
-                                parts = [p.strip() for p in line.split(',')]
-                                if len(parts) > 1:
-                                    custom_map[parts[0]] = parts
-                        if custom_map:
-                            max_level = max(len(v) for v in custom_map.values()) - 1
-                        else:
-                            max_level = 0
-                        hierarchy_dict = {0: df[col].values}
-                        for lvl in range(1, max_level + 1):
-                            hierarchy_dict[lvl] = df[col].astype(str).apply(
-                                lambda x, lvl=lvl: custom_map[x][lvl] if x in custom_map and len(custom_map[x]) > lvl else " not able to map"
-                            ).values
-                        hierarchies[col] = hierarchy_dict
+                        custom_hierarchy = MappingHierarchy.from_text(col, custom_text)
+                        specs[col] = {'type': 'custom', 'text': custom_text}
+                        hierarchy_keys[col] = ('custom', col, custom_hierarchy.fingerprint)
                     else:
-                        hierarchies[col] = {0: df[col].values}
+                        specs[col] = {'type': 'none'}
 
                 elif chosen_type == 'default':
-                    # only applicable for adult.csv dataset with this possible columns
-                                        
-                    if col == 'age':
-                        hierarchies[col] = {
-                            0: df["age"].values,
-                            1: utils.generate_intervals(df["age"].values, 0, 100, 3),
-                            2: utils.generate_intervals(df["age"].values, 0, 100, 5),
-                            3: utils.generate_intervals(df["age"].values, 0, 100, 10),
-                            4: utils.generate_intervals(df["age"].values, 0, 100, 20),
-                            5: utils.generate_intervals(df["age"].values, 0, 100, 50),
-                        }
-                    
-                    if col == 'sex':
-                        hierarchy_dict = {0: df[col].values}
-                        column_hierarchy = {
-                            'Male': ['Male', 'Human'], 
-                            'Female': ['Female', 'Human']
-                        }
-                        max_hierarchy_level = len(next(iter(column_hierarchy.values())))
-                        for lvl in range(1, max_hierarchy_level):
-                            hierarchy_dict[lvl] = df[col].map(
-                                lambda x, lvl=lvl: column_hierarchy.get(x, [" not able to map"] * max_hierarchy_level)[lvl]
-                            ).values
-                        hierarchies[col] = hierarchy_dict
-                    
-                    if col == 'race':
-                        hierarchy_dict = {0: df[col].values}
-                        column_hierarchy = {
-                            'White': ['White', 'White', 'Race'], 
-                            'Black': ['Black', 'Black', 'Race'], 
-                            'Asian-Pac': ['Asian-Pac', 'Asian/Pac', 'Race'], 
-                            'Amer-India': ['Amer-India', 'Native Am', 'Race'], 
-                            'Other': ['Other', 'Other', 'Race']
-                        }
-                        max_hierarchy_level = len(next(iter(column_hierarchy.values())))
-                        for lvl in range(1, max_hierarchy_level):
-                            hierarchy_dict[lvl] = df[col].map(
-                                lambda x, lvl=lvl: column_hierarchy.get(x, [" not able to map"] * max_hierarchy_level)[lvl]
-                            ).values
-                        hierarchies[col] = hierarchy_dict
-                    
-                    if col == 'relationship':
-                        hierarchy_dict = {0: df[col].values}
-                        column_hierarchy = {
-                            'Not-in-family': ['Not-in-family', 'Not Family', 'Relationship'], 
-                            'Husband': ['Husband', 'Spouse', 'Relationship'], 
-                            'Wife': ['Wife', 'Spouse', 'Relationship'], 
-                            'Own-child': ['Own-child', 'Child', 'Relationship'], 
-                            'Unmarried': ['Unmarried', 'Not Family', 'Relationship'], 
-                            'Other-relative': ['Other-relative', 'Other Rela', 'Relationship']
-                        }
-                        max_hierarchy_level = len(next(iter(column_hierarchy.values())))
-                        for lvl in range(1, max_hierarchy_level):
-                            hierarchy_dict[lvl] = df[col].map(
-                                lambda x, lvl=lvl: column_hierarchy.get(x, [" not able to map"] * max_hierarchy_level)[lvl]
-                            ).values
-                        hierarchies[col] = hierarchy_dict
-                    
-                    if col == 'occupation':
-                        hierarchy_dict = {0: df[col].values}
-                        column_hierarchy = {
-                            'Adm-cleric': ['Adm-cleric', 'Clerical/Admin', 'Office/Admin', 'Office/Management', 'Occupation'], 
-                            'Exec-managerial': ['Exec-managerial', 'Executive/Managerial', 'Management/Sales', 'Office/Management', 'Occupation'], 
-                            'Handlers-cleaners': ['Handlers-cleaners', 'Cleaning/Handling', 'Manual Labor', 'General Labor/Service', 'Occupation'], 
-                            'Prof-specialty': ['Prof-specialty', 'Specialized Professional', 'Professional', 'Professional/Specialized', 'Occupation'], 
-                            'Other-service': ['Other-service', 'General Services', 'Service', 'General Labor/Service', 'Occupation'], 
-                            'Sales': ['Sales', 'Sales/Marketing', 'Management/Sales', 'Office/Management', 'Occupation'], 
-                            'Craft-repair': ['Craft-repair', 'Craft/Repair', 'Skilled Trades', 'Skilled Trades/Technical', 'Occupation'], 
-                            'Transport-moving': ['Transport-moving', 'Moving/Transport', 'Transportation', 'Skilled Trades/Technical', 'Occupation'], 
-                            'Farming-fishing': ['Farming-fishing', 'Agriculture/Fishing', 'Manual Labor', 'General Labor/Service', 'Occupation'], 
-                            'Machine-op-inspct': ['Machine-op-inspct', 'Machine Operation', 'Skilled Trades', 'Skilled Trades/Technical', 'Occupation'], 
-                            'Tech-support': ['Tech-support', 'Technical Support', 'Office/Admin', 'Office/Management', 'Occupation'], 
-                            '?': ['?', 'Unclassified', 'Unknown', 'Other/Unknown', 'Occupation'], 
-                            'Protective-serv': ['Protective-serv', 'Protective Services', 'Protective', 'Professional/Specialized', 'Occupation'], 
-                            'Armed-Forces': ['Armed-Forces', 'Armed Forces', 'Military', 'Other/Unknown', 'Occupation'], 
-                            'Priv-house-serv': ['Priv-house-serv', 'Private Household', 'Service', 'General Labor/Service', 'Occupation']
-                        }
-                        max_hierarchy_level = len(next(iter(column_hierarchy.values())))
-                        for lvl in range(1, max_hierarchy_level):
-                            hierarchy_dict[lvl] = df[col].map(
-                                lambda x, lvl=lvl: column_hierarchy.get(x, [" not able to map"] * max_hierarchy_level)[lvl]
-                            ).values
-                        hierarchies[col] = hierarchy_dict
-                    
-                    if col == 'marital-status':
-                        hierarchy_dict = {0: df[col].values}
-                        column_hierarchy = {
-                            'Never-married': ['Never-married', 'Unmarried', 'marital-status'],
-                            'Married-civ-spouse': ['Married-civ-spouse', 'Married', 'marital-status'],
-                            'Divorced': ['Divorced', 'Unmarried', 'marital-status'],
-                            'Married-spouse-absent': ['Married-spouse-absent', 'Married', 'marital-status'],
-                            'Separated': ['Separated', 'Unmarried', 'marital-status'],
-                            'Married-AF-spouse': ['Married-AF-spouse', 'Married', 'marital-status'], 
-                            'Widowed': ['Widowed', 'Unmarried', 'marital-status']
-                        }
-                        max_hierarchy_level = len(next(iter(column_hierarchy.values())))
-                        for lvl in range(1, max_hierarchy_level):
-                            hierarchy_dict[lvl] = df[col].map(
-                                lambda x, lvl=lvl: column_hierarchy.get(x, [" not able to map"] * max_hierarchy_level)[lvl]
-                            ).values
-                        hierarchies[col] = hierarchy_dict
-                    
-                    if col == 'education':
-                        hierarchy_dict = {0: df[col].values}
-                        column_hierarchy = {
-                            "HS-grad": ["HS-grad", "School", "Study"],
-                            "11th": ["11th", "School", "Study"],
-                            "Masters": ["Masters", "Masters", "Study"],
-                            "9th": ["9th", "School", "Study"],
-                            "Some-college": ["Some-college", "School", "Study"],
-                            "Assoc-acdm": ["Assoc-acdm", "School", "Study"],
-                            "Assoc-voc": ["Assoc-voc", "School", "Study"],
-                            "7th-8th": ["7th-8th", "School", "Study"],
-                            "Doctorate": ["Doctorate", "Doctorate", "Study"],
-                            "Prof-school": ["Prof-school", "School", "Study"],
-                            "5th-6th": ["5th-6th", "School", "Study"],
-                            "10th": ["10th", "School", "Study"],
-                            "1st-4th": ["1st-4th", "School", "Study"],
-                            "Preschool": ["Preschool", "Preschool", "Study"],
-                            "12th": ["12th", "School", "Study"],
-                            "Bachelors": ["Bachelors", "Bachelors", "Study"],
-                        }
-                        max_hierarchy_level = len(next(iter(column_hierarchy.values())))
-                        for lvl in range(1, max_hierarchy_level):
-                            hierarchy_dict[lvl] = df[col].map(
-                                lambda x, lvl=lvl: column_hierarchy.get(x, [" not able to map"] * max_hierarchy_level)[lvl]
-                            ).values
-                        hierarchies[col] = hierarchy_dict
+                    # Hierarchies are looked up by name in the registry; the
+                    # built-in ones are named after the adult.csv columns.
+                    name = chosen_level if chosen_level in hierarchy_registry else col
+                    registered = hierarchy_registry.get(name)
+                    if registered is not None:
+                        specs[col] = {'type': 'default', 'name': name}
+                        hierarchy_keys[col] = ('registry', col, registered.fingerprint)
                 
                 else:
-                    hierarchies[col] = {0: df[col].values}
+                    specs[col] = {'type': 'none'}
                 
 
         
-        # Run the chosen anonymization
-        try:
-            if method == "l_diversity":
-                if len(sens_att_list) != 1:
-                    flash("For l-diversity, please select exactly one sensitive attribute.")
-                    return redirect(url_for('select_columns', filename=filename))
-                anonymized_df = anonymity.l_diversity(
-                    data=df,
-                    ident=ident,
-                    quasi_ident=quasi_ident,
-                    sens_att=sens_att_list[0],
-                    k=k_value,
-                    l_div=l_div,
-                    supp_level=supp_level_value,
-                    hierarchies=hierarchies
-                )
-                # flash(anonymized_df)
-            else:
-                print(df.shape)
-                anonymized_df = anonymity.k_anonymity(
-                    data=df,
-                    ident=ident,
-                    quasi_ident=quasi_ident,
-                    k=k_value,
-                    supp_level=supp_level_value,
-                    hierarchies=hierarchies
-                )
-        except Exception as e:
-            flash("Anonymization error: " + str(e))
-            return redirect(url_for('select_columns', filename=filename))
+        if method == "l_diversity" and len(sens_att_list) != 1:
+            return form_error("For l-diversity, please select exactly one sensitive attribute.", redirect_back=True)
+        
+        # Large uploads are profiled rather than loaded; only the columns with a
+        # role are read for them, the others are restored when writing the result.
+        streamed = isinstance(profile, DatasetProfile)
+        role_columns = [col for col in columns if col in roles] if streamed else None
+        source = dataset_cache.source(filepath)
+        passthrough = (source, columns) if streamed else None
+        
+        if preview:
+            try:
+                dataset = dataset_cache.get(filepath, columns=role_columns)
+            except Exception as e:
+                return form_error("Error reading CSV: " + str(e))
+            # Work on a shallow copy so that column replacements (e.g. masking)
+            # never modify the cached dataset.
+            df = dataset.df.copy(deep=False)
+            try:
+                hierarchies = dataset_hierarchies(dataset, df, specs, hierarchy_keys)
+            except ValueError as e:
+                return form_error(str(e), redirect_back=True)
+            sens_att = sens_att_list[0] if method == "l_diversity" else None
+            for col in quasi_ident:
+                if col in hierarchies and col not in hierarchy_keys:
+                    hierarchy_keys[col] = ('none', col)
+            index_key = ('equivalence_index', tuple(quasi_ident), sens_att, hierarchy_keys.get(sens_att),
+                         tuple(hierarchy_keys.get(col) for col in quasi_ident))
+            index = dataset_cache.hierarchy(
+                dataset, index_key,
+                lambda: EquivalenceIndex(df, quasi_ident, hierarchies, sens_att)
+            )
+            plan = index.plan(method, k_value, supp_level_value, l_div if sens_att else None)
+            # The index keeps the lattice nodes the search visited
+            dataset_cache.recharge(dataset, index_key)
+            return jsonify(plan)
+        
         
-        processed_filename = f'anonymized_{filename}'
-        processed_filepath = os.path.join(PROCESSED_FOLDER, processed_filename)
-        anonymized_df.to_csv(processed_filepath, index=False)
+        params = {
+            'method': method,
+            'ident': ident,
+            'quasi_ident': quasi_ident,
+            'sens_att_list': sens_att_list,
+            'k': k_value,
+            'l_div': l_div if method == "l_diversity" else None,
+            'supp_level': supp_level_value,
+            'engine': engine,
+        }
         
-        preview_html = anonymized_df.head(100).to_html(classes="table table-striped", index=False)
-        return render_template('preview.html', anonymized_table=preview_html, download_filename=processed_filename)
+        # Results are stored under the content of the upload and the settings
+        # that change the output (not the engine, both give the same result),
+        # so the same run on the same data is served from the stored result.
+        cache_key = result_key(profile.content_hash, {
+            'method': method,
+            'k': k_value,
+            'l_div': params['l_div'],
+            'supp_level': supp_level_value,
+            'ident': sorted(ident),
+            'quasi_ident': quasi_ident,
+            'sensitive': sens_att_list,
+            'hierarchies': {col: list(hierarchy_keys.get(col, ('none', col))) for col in sorted(specs)},
+        })
+        cache_requests = ('anonymizer_result_cache_requests_total', 'Anonymization requests by result cache outcome.')
+        if result_cache.get(cache_key) is not None:
+            instrumentation.metrics.inc(*cache_requests, outcome='hit')
+            result_url = url_for('cached_result', result_id=cache_key, filename=filename)
+            if wants_json():
+                return jsonify(result_id=cache_key, result_url=result_url, cached=True)
+            return redirect(result_url)
+        
+        # Opt-in cProfile capture of the job
+        profile_path = None
+        if PROFILE_ALL_JOBS or request.form.get('profile') == '1':
+            os.makedirs(PROFILE_FOLDER, exist_ok=True)
+            profile_path = os.path.join(PROFILE_FOLDER, f"{g.request_id}.prof")
+        
+        # Run the chosen anonymization in the background, or follow the job
+        # already running it for an identical request
+        try:
+            with pending_lock:
+                job = job_manager.get(pending_results.get(cache_key, ''))
+                if job is not None and job.status not in FINISHED_STATES:
+                    job_id = job.id
+                    instrumentation.metrics.inc(*cache_requests, outcome='pending')
+                else:
+                    job_id = job_manager.submit(
+                        pipeline.run_anonymization_from_source, source, role_columns, specs,
+                        HIERARCHY_FOLDER, params, result_cache.path(cache_key), passthrough, profile_path,
+                        description=f"{method} on {filename} ({engine})",
+                        context={'result_key': cache_key}
+                    )
+                    pending_results[cache_key] = job_id
+                    instrumentation.metrics.inc(*cache_requests, outcome='miss')
+        except QueueFull as e:
+            if wants_json():
+                return jsonify(error=str(e)), 503
+            flash(str(e))
+            return render_form(503)
+        
+        # The job may be shared with other uploads of the same content, so the
+        # file name of this request goes along with the job's URLs
+        if wants_json():
+            return jsonify(job_id=job_id, status_url=url_for('job_status', job_id=job_id, filename=filename)), 202
+        return redirect(url_for('job_page', job_id=job_id, filename=filename))
     
+    return render_form()
+
+def dataset_hierarchies(dataset, df, specs, hierarchy_keys):
+    """
+    Build the hierarchies of specs (see pipeline.build_hierarchies) for a
+    dataset entry, caching those with a key in hierarchy_keys on the entry.
+    Masked columns are replaced in df, a shallow copy of the entry's data.
+    """
+    hierarchies = {}
+    for col, spec in specs.items():
+        if col not in hierarchy_keys:
+            hierarchies.update(pipeline.build_hierarchies(df, {col: spec}, hierarchy_registry))
+        elif spec['type'] == 'masking':
+            hierarchies[col], df[col] = dataset_cache.hierarchy(
+                dataset, hierarchy_keys[col],
+                lambda col=col, align=spec['align']: hierarchy_builders.column_masking_hierarchy(df[col], align)
+            )
+        else:
+            hierarchies[col] = dataset_cache.hierarchy(
+                dataset, hierarchy_keys[col],
+                lambda col=col, spec=spec: pipeline.build_hierarchies(df, {col: spec}, hierarchy_registry)[col]
+            )
+    return hierarchies
+
+def wants_json():
+    """
+    True when the client asked for a JSON response instead of an HTML page.
+    """
+    return request.accept_mimetypes.best == 'application/json'
+
+@app.route('/jobs/<job_id>')
+def job_page(job_id):
+    """
+    Progress page of an anonymization job; it polls job_status and moves on
+    to the result once the job is done.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        flash("Unknown or expired job")
+        return redirect(url_for('upload_file'))
+    return render_template('job.html', job=job.to_dict(), filename=request.args.get('filename'))
+
+@app.route('/jobs/<job_id>/status')
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    status = job.to_dict()
+    if job.status == 'done':
+        status['result_url'] = url_for('job_result', job_id=job_id, filename=request.args.get('filename'))
+    return jsonify(status)
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    cancelled = job_manager.cancel(job_id)
+    if wants_json():
+        return jsonify(cancelled=cancelled)
+    if not cancelled:
+        flash("The job could not be cancelled because it has already finished")
+    return redirect(url_for('job_page', job_id=job_id))
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """
+    Show the preview of a finished job.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        flash("Unknown or expired job")
+        return redirect(url_for('upload_file'))
+    if job.status != 'done':
+        return redirect(url_for('job_page', job_id=job_id))
+    return render_result(
+        job.context['result_key'], request.args.get('filename'),
+        job.result['preview_html'], job.result['rows'],
+        profile_url=url_for('job_profile', job_id=job_id, format='text') if job.result.get('profile_path') else None
+    )
+
+@app.route('/results/<result_id>')
+def cached_result(result_id):
+    """
+    Show the preview of a stored result.
+    """
+    meta = result_cache.get(result_id)
+    if meta is None:
+        flash("Unknown or expired result")
+        return redirect(url_for('upload_file'))
+    return render_result(result_id, request.args.get('filename'), meta['preview_html'], meta['rows'])
+
+def render_result(result_id, source_filename, preview_html, total_rows, profile_url=None):
     return render_template(
-        'select_columns.html',
-        columns=columns,
-        col_types=col_types,
-        max_len_map=max_len_map,
-        original_preview=original_preview
+        'preview.html',
+        anonymized_table=preview_html,
+        result_id=result_id,
+        source_filename=source_filename,
+        total_rows=total_rows,
+        parquet_available=columnar.available(),
+        compressions=[c for c in result_files.COMPRESSIONS if result_files.compression_available(c)],
+        profile_url=profile_url
     )
 
+@app.route('/jobs/<job_id>/profile')
+def job_profile(job_id):
+    """
+    cProfile stats of a finished job run with profiling: the .prof file, or
+    the 50 most expensive functions by cumulative time with ?format=text.
+    """
+    job = job_manager.get(job_id)
+    if job is None or job.status != 'done' or not job.result.get('profile_path'):
+        return jsonify(error="No profile for this job"), 404
+    profile_path = job.result['profile_path']
+    if not os.path.exists(profile_path):
+        return jsonify(error="The profile of this job was removed"), 404
+    if request.args.get('format') == 'text':
+        out = io.StringIO()
+        pstats.Stats(profile_path, stream=out).sort_stats('cumulative').print_stats(50)
+        return Response(out.getvalue(), mimetype='text/plain')
+    return send_file(profile_path, as_attachment=True, download_name=f"{job_id}.prof")
+
+@app.route('/results/<result_id>/rows')
+def result_rows(result_id):
+    """
+    One page of a stored result as JSON: ?start=0&count=100 gives the
+    columns, the rows (as stored text) and the total row count. Only the
+    requested range is read, from the row index written with the result.
+    """
+    filepath = result_cache.path(result_id)
+    if not is_key(result_id) or not os.path.isfile(filepath):
+        return jsonify(error="Unknown result"), 404
+    try:
+        start = max(int(request.args.get('start', 0)), 0)
+        count = min(max(int(request.args.get('count', 100)), 1), MAX_PREVIEW_ROWS)
+    except ValueError:
+        return jsonify(error="start and count must be integers"), 400
+    with instrumentation.span('read_result_rows') as record:
+        try:
+            rows, total = result_files.read_rows(filepath, start, count)
+        except FileNotFoundError:
+            # Evicted meanwhile
+            return jsonify(error="Unknown result"), 404
+        except pd.errors.EmptyDataError:
+            # anjana's empty result has no header
+            rows, total = pd.DataFrame(), 0
+        record['rows'] = len(rows)
+    return jsonify(columns=list(rows.columns), rows=rows.to_numpy().tolist(), start=start, count=len(rows), total=total)
+
+@app.route('/results/<result_id>/download')
+def download_result(result_id):
+    """
+    Download a stored result, as for download_file, under the name
+    anonymized_<filename> (the upload name given as ?filename=).
+    """
+    if result_cache.get(result_id) is None:
+        flash("Unknown or expired result")
+        return redirect(url_for('index'))
+    filename = os.path.basename(request.args.get('filename') or 'result.csv')
+    return send_result(result_cache.path(result_id), f'anonymized_{filename}', result_cache.parquet_path(result_id))
+
 @app.route('/download/<filename>')
 def download_file(filename):
+    """
+    Download a processed file as CSV, streamed as it is read and compressed
+    on the fly with ?compression=gzip or zstd, or as Parquet with
+    ?format=parquet.
+    """
     filepath = os.path.join(PROCESSED_FOLDER, filename)
-    return send_file(filepath, as_attachment=True)
+    if not os.path.isfile(filepath):
+        flash("Unknown result file")
+        return redirect(url_for('index'))
+    return send_result(filepath, filename, os.path.splitext(filepath)[0] + '.parquet')
+
+def send_result(filepath, filename, parquet_path):
+    """
+    Response downloading a CSV result as filename, per the format and compression arguments.
+    """
+    if request.args.get('format') == 'parquet':
+        if not columnar.available():
+            flash("Parquet output requires pyarrow to be installed")
+            return redirect(url_for('index'))
+        try:
+            columnar.csv_to_parquet(filepath, parquet_path)
+        except ValueError as e:
+            flash(str(e))
+            return redirect(url_for('index'))
+        return send_file(parquet_path, as_attachment=True,
+                         download_name=os.path.splitext(filename)[0] + '.parquet')
+    compression = request.args.get('compression') or None
+    if compression is not None and not result_files.compression_available(compression):
+        flash(f"Unsupported compression: {compression}")
+        return redirect(url_for('index'))
+    response = Response(stream_with_context(result_files.stream_file(filepath, compression)),
+                        mimetype='text/csv' if compression is None else f'application/{compression}')
+    response.headers.set('Content-Disposition', 'attachment',
+                         filename=filename + (result_files.COMPRESSIONS[compression] if compression else ''))
+    if compression is None:
+        response.headers['Content-Length'] = str(os.path.getsize(filepath))
+    return response
 
 if __name__ == '__main__':
     app.run(debug=True)
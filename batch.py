@@ -0,0 +1,294 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import partitioned
+import pipeline
+import result_files
+from dataset_cache import compact_dataframe
+from hierarchy_builders import MASKING_ALIGNMENTS
+from hierarchy_registry import load_registry
+
+METHODS = ('k_anonymity', 'l_diversity')
+HIERARCHY_TYPES = ('none', 'masking', 'custom', 'default', 'file')
+
+
+class BatchConfig:
+    """
+    Declarative anonymization settings, the batch counterpart of the column
+    selection page. As a dict (or JSON file):
+
+        {
+            "method": "k_anonymity" | "l_diversity",
+            "k": 2, "l_div": 2, "supp_level": 5,
+            "engine": "native",
+            "ident": ["zipcode"],
+            "quasi_ident": ["age", "creditcard", "gender"],
+            "sensitive": "salary",
+            "hierarchies": {
+                "age": {"type": "custom", "text": "23,20s,any\\n..."},
+                "creditcard": {"type": "masking", "align": "right"},
+                "gender": {"type": "file", "path": "hierarchies/gender.csv"}
+            },
+            "hierarchy_folder": "hierarchies"
+        }
+
+    Hierarchies use the specs of pipeline.build_hierarchies. Columns without
+    a role are passed through unchanged.
+    """
+
+    def __init__(self, quasi_ident, method='k_anonymity', k=2, l_div=None, supp_level=0, ident=(),
+                 sensitive=None, hierarchies=None, engine=pipeline.DEFAULT_ENGINE, hierarchy_folder='hierarchies'):
+        self.method = method
+        self.k = k
+        self.l_div = l_div
+        self.supp_level = supp_level
+        self.ident = list(ident)
+        self.quasi_ident = list(quasi_ident)
+        self.sensitive = sensitive
+        self.hierarchies = dict(hierarchies or {})
+        self.engine = engine
+        self.hierarchy_folder = hierarchy_folder
+        self.validate()
+
+    @classmethod
+    def from_dict(cls, data):
+        known = ('method', 'k', 'l_div', 'supp_level', 'ident', 'quasi_ident', 'sensitive',
+                 'hierarchies', 'engine', 'hierarchy_folder')
+        unknown = sorted(set(data) - set(known))
+        if unknown:
+            raise ValueError(f"Unknown configuration keys: {', '.join(unknown)}")
+        if 'quasi_ident' not in data:
+            raise ValueError("The configuration needs a quasi_ident list")
+        return cls(**data)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a JSON configuration. A relative hierarchy_folder or hierarchy
+        file path is taken relative to the configuration file.
+        """
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        base = os.path.dirname(os.path.abspath(path))
+        if 'hierarchy_folder' in data:
+            data['hierarchy_folder'] = os.path.join(base, data['hierarchy_folder'])
+        for spec in data.get('hierarchies', {}).values():
+            if spec.get('type') == 'file' and 'path' in spec:
+                spec['path'] = os.path.join(base, spec['path'])
+        return cls.from_dict(data)
+
+    def validate(self):
+        """
+        The checks of the configuration form; raises ValueError.
+        """
+        if self.method not in METHODS:
+            raise ValueError(f"Unknown method {self.method!r} (expected one of {', '.join(METHODS)})")
+        if self.engine not in pipeline.ENGINES:
+            raise ValueError(f"Unknown engine {self.engine!r} (expected one of {', '.join(pipeline.ENGINES)})")
+        if not isinstance(self.k, int) or not isinstance(self.supp_level, int):
+            raise ValueError("Invalid k or suppression level. Please enter valid integers.")
+        if not self.quasi_ident:
+            raise ValueError("Please select at least one quasi-identifier column.")
+        if self.method == 'l_diversity':
+            if self.l_div is None:
+                self.l_div = 2
+            if not isinstance(self.l_div, int):
+                raise ValueError("Invalid l value for l-diversity. Please enter a valid integer.")
+            if not self.sensitive:
+                raise ValueError("For l-diversity, please select exactly one sensitive attribute.")
+        roles = self.ident + self.quasi_ident + ([self.sensitive] if self.sensitive else [])
+        if len(set(roles)) != len(roles):
+            raise ValueError("A column can only have one role")
+        for col, spec in self.hierarchies.items():
+            if spec.get('type', 'none') not in HIERARCHY_TYPES:
+                raise ValueError(f"Unknown hierarchy type {spec.get('type')!r} for column {col}")
+            if spec.get('type') == 'file' and 'path' not in spec:
+                raise ValueError(f"Hierarchy file of column {col} has no path")
+            if spec.get('type') == 'masking' and spec.get('align', 'right') not in MASKING_ALIGNMENTS:
+                raise ValueError(f"Unknown masking alignment {spec.get('align')!r} for column {col}")
+
+    @property
+    def role_columns(self):
+        return self.ident + self.quasi_ident + ([self.sensitive] if self.sensitive else [])
+
+    def to_dict(self):
+        return {
+            'method': self.method, 'k': self.k, 'l_div': self.l_div, 'supp_level': self.supp_level,
+            'ident': self.ident, 'quasi_ident': self.quasi_ident, 'sensitive': self.sensitive,
+            'hierarchies': self.hierarchies, 'engine': self.engine, 'hierarchy_folder': self.hierarchy_folder,
+        }
+
+
+def expand_inputs(patterns):
+    """
+    Input CSV files for a list of paths, glob patterns and directories (every
+    .csv file in them), in order and without duplicates.
+    """
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(glob.glob(os.path.join(pattern, '*.csv')))
+        else:
+            matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            raise ValueError(f"No input files match {pattern}")
+        for path in matches:
+            if not os.path.isfile(path):
+                raise ValueError(f"Not a file: {path}")
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def output_path_for(path, output_dir, compression=None):
+    extension = result_files.COMPRESSIONS[compression] if compression else ''
+    return os.path.join(output_dir, f"anonymized_{os.path.basename(path)}{extension}")
+
+
+def anonymize_file(path, config, output_path, partition_rows=None, workers=None, compression=None):
+    """
+    Anonymize one CSV file with a BatchConfig and write the result to
+    output_path. Only the columns with a role are loaded; the others are
+    restored from the file when the result is written, as for large uploads
+    in the web application. Returns the summary of pipeline.run_anonymization
+    (without the preview).
+
+    With partition_rows, the file is anonymized out of core instead, in
+    partitions of at most that many rows spread over workers processes
+    (see partitioned.anonymize_partitioned). compression ("gzip" or "zstd")
+    compresses the output as it is written.
+    """
+    if isinstance(config, dict):
+        config = BatchConfig.from_dict(config)
+    if partition_rows:
+        return partitioned.anonymize_partitioned(
+            path, output_path, config.method, config.ident, config.quasi_ident, config.sensitive,
+            config.k, config.l_div, config.supp_level, config.hierarchies, engine=config.engine,
+            hierarchy_folder=config.hierarchy_folder, partition_rows=partition_rows, workers=workers,
+            compression=compression
+        )
+    columns = list(pd.read_csv(path, nrows=0).columns)
+    missing = [col for col in config.role_columns if col not in columns]
+    if missing:
+        raise ValueError(f"Columns not in {path}: {', '.join(missing)}")
+    roles = [col for col in columns if col in config.role_columns]
+
+    df = compact_dataframe(pd.read_csv(path, usecols=roles))
+    specs = {col: spec for col, spec in config.hierarchies.items() if col in roles}
+    hierarchies = pipeline.build_hierarchies(df, specs, load_registry(config.hierarchy_folder))
+    params = {
+        'df': df,
+        'method': config.method,
+        'ident': config.ident,
+        'quasi_ident': config.quasi_ident,
+        'sens_att_list': [config.sensitive] if config.sensitive else [],
+        'k': config.k,
+        'l_div': config.l_div,
+        'supp_level': config.supp_level,
+        'hierarchies': hierarchies,
+        'engine': config.engine,
+    }
+    passthrough = (path, columns) if len(roles) < len(columns) else None
+    with pipeline.suppress_progress():
+        result = pipeline.run_anonymization(params, output_path, passthrough, compression=compression)
+    result.pop('preview_html')
+    return result
+
+
+def _run_file(path, config, output_path, partition_rows=None, workers=None, compression=None):
+    start = time.perf_counter()
+    try:
+        result = anonymize_file(path, config, output_path, partition_rows, workers, compression)
+    except Exception as e:
+        return {'input': path, 'status': 'error', 'error': f"{type(e).__name__}: {e}",
+                'seconds': time.perf_counter() - start}
+    return {
+        'input': path,
+        'output': result['output_path'],
+        # anjana returns an empty result when the settings cannot be reached
+        'status': 'ok' if result['rows'] else 'impossible',
+        'rows': result['rows'],
+        'seconds': time.perf_counter() - start,
+        'stages': {span['stage']: span['seconds'] for span in result['spans']},
+    }
+
+
+def anonymize_files(paths, config, output_dir, workers=None, partition_rows=None, compression=None):
+    """
+    Anonymize many CSV files with the same configuration, one file per worker
+    process, writing anonymized_<name> files to output_dir. A failing file
+    does not stop the others; its summary has status "error".
+    With partition_rows, the files are taken one at a time and the workers
+    anonymize the partitions of each (see anonymize_file).
+    Returns one summary dict per file, in input order.
+    """
+    if isinstance(config, dict):
+        config = BatchConfig.from_dict(config)
+    names = [os.path.basename(path) for path in paths]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Several inputs would write the same output: {', '.join(duplicates)}")
+    if compression:
+        result_files.check_compression(compression)
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = [output_path_for(path, output_dir, compression) for path in paths]
+
+    if partition_rows:
+        return [_run_file(path, config, output, partition_rows, workers, compression)
+                for path, output in zip(paths, outputs)]
+    workers = min(workers or os.cpu_count() or 1, len(paths))
+    if workers <= 1:
+        return [_run_file(path, config, output, compression=compression) for path, output in zip(paths, outputs)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_run_file, paths, [config] * len(paths), outputs, [None] * len(paths),
+                                 [None] * len(paths), [compression] * len(paths)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Anonymize CSV files without the web application, with the settings of a JSON configuration."
+    )
+    parser.add_argument('inputs', nargs='+', help="CSV files, directories or glob patterns")
+    parser.add_argument('-c', '--config', required=True, help="JSON configuration (see batch.BatchConfig)")
+    parser.add_argument('-o', '--output-dir', default='processed')
+    parser.add_argument('-w', '--workers', type=int, help="worker processes (default: number of CPUs)")
+    parser.add_argument('--engine', choices=pipeline.ENGINES, help="override the engine of the configuration")
+    parser.add_argument('--partition-rows', type=int,
+                        help="anonymize out of core, in partitions of at most this many rows (for files larger than memory)")
+    parser.add_argument('--compression', choices=sorted(result_files.COMPRESSIONS),
+                        help="compress the results as they are written")
+    parser.add_argument('--summary', help="write the per-file results to this JSON file")
+    args = parser.parse_args(argv)
+
+    try:
+        config = BatchConfig.load(args.config)
+        if args.engine:
+            config.engine = args.engine
+        paths = expand_inputs(args.inputs)
+        results = anonymize_files(paths, config, args.output_dir, args.workers, args.partition_rows,
+                                  args.compression)
+    except (OSError, ValueError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 2
+
+    for result in results:
+        if result['status'] == 'error':
+            print(f"{result['input']}: {result['error']}", file=sys.stderr)
+        else:
+            print(f"{result['input']} -> {result['output']}: {result['status']}, "
+                  f"{result['rows']} rows in {result['seconds']:.2f}s")
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            json.dump({'config': config.to_dict(), 'results': results}, f, indent=2)
+    return 1 if any(result['status'] == 'error' for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,284 @@
+import argparse
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+
+from instrumentation import current_rss, peak_rss
+
+BENCH_FOLDER = 'bench_data'
+MAX_ANJANA_ROWS = 100_000
+
+# The select_columns workflow for every bundled dataset: column roles and hierarchies
+DATASETS = {
+    'adult': {
+        'path': os.path.join('uploads', 'adult.csv'),
+        'ident': [],
+        'quasi_ident': ['age', 'education', 'marital-status', 'relationship', 'race', 'sex'],
+        'sensitive': 'occupation',
+        'hierarchies': {col: {'type': 'default'} for col in
+                        ['age', 'education', 'marital-status', 'relationship', 'race', 'sex']},
+    },
+    'synthetic_data': {
+        'path': 'synthetic_data.csv',
+        'ident': ['ID'],
+        'quasi_ident': ['Age', 'Gender', 'ZipCode'],
+        'sensitive': 'Occupation',
+        'hierarchies': {
+            'Age': {'type': 'custom', 'text': '\n'.join(f'{a},{a // 5 * 5}-{a // 5 * 5 + 4},*' for a in range(100))},
+            'Gender': {'type': 'none'},
+            'ZipCode': {'type': 'masking'},
+        },
+    },
+    'newData': {
+        'path': os.path.join('uploads', 'newData.csv.csv'),
+        'ident': ['zipcode'],
+        'quasi_ident': ['age', 'creditcard', 'gender'],
+        'sensitive': 'salary',
+        'hierarchies': {
+            'age': {'type': 'custom', 'text': '\n'.join(f'{a},{a // 10 * 10}s,any' for a in range(100))},
+            'creditcard': {'type': 'masking'},
+            'gender': {'type': 'custom', 'text': 'Male,Human\nFemale,Human'},
+        },
+    },
+}
+SCALED_DATASET = 'adult'
+
+DEFAULT_GRID = {'k': [2, 5, 10], 'l_div': [2, 3], 'supp_level': [0, 5, 20]}
+QUICK_GRID = {'k': [2], 'l_div': [2], 'supp_level': [5]}
+
+
+@contextlib.contextmanager
+def stage(stages, name, rows=None):
+    """
+    Record the wall time, memory and throughput of a stage: the RSS growth
+    over the stage (with psutil) and the peak RSS of the process so far,
+    which covers the earlier stages too. The row count can also be set
+    inside the block, as record['rows'].
+    """
+    record = {'rows': rows}
+    rss_before = current_rss()
+    start = time.perf_counter()
+    yield record
+    seconds = time.perf_counter() - start
+    rss_after = current_rss()
+    stages[name] = {
+        'seconds': seconds,
+        'rss_delta_bytes': rss_after - rss_before if rss_after is not None else None,
+        'cumulative_peak_rss_bytes': peak_rss(),
+        'rows_per_second': record['rows'] / seconds if record['rows'] is not None and seconds > 0 else None,
+    }
+
+
+def scaled_copy(path, factor, folder=BENCH_FOLDER):
+    """
+    CSV with the rows of path repeated factor times, written once and reused.
+    """
+    os.makedirs(folder, exist_ok=True)
+    name, ext = os.path.splitext(os.path.basename(path))
+    target = os.path.join(folder, f"{name}_x{factor}{ext}")
+    with open(path, 'rb') as f:
+        header = f.readline()
+        body = f.read()
+    if not body.endswith(b'\n'):
+        body += b'\n'
+    expected_size = len(header) + len(body) * factor
+    if os.path.exists(target) and os.path.getsize(target) == expected_size:
+        return target
+    tmp_path = f"{target}.{uuid.uuid4().hex}.part"
+    with open(tmp_path, 'wb') as out:
+        out.write(header)
+        for _ in range(factor):
+            out.write(body)
+    os.replace(tmp_path, target)
+    return target
+
+
+def grid_points(grid):
+    """
+    Every (method, k, l_div, supp_level) setting of a grid.
+    """
+    for k, supp_level in itertools.product(grid['k'], grid['supp_level']):
+        yield 'k_anonymity', k, None, supp_level
+    for k, l_div, supp_level in itertools.product(grid['k'], grid['l_div'], grid['supp_level']):
+        yield 'l_diversity', k, l_div, supp_level
+
+
+def run_dataset(name, path, scale, engine, grid):
+    """
+    Load a dataset, build its hierarchies and anonymize it at every grid
+    point, as the select_columns page does. Runs in a fresh process, so the
+    peak RSS figures only cover this dataset and engine.
+    """
+    from dataset_cache import DatasetCache, DatasetProfile
+    from hierarchy_registry import HierarchyRegistry
+    import pipeline
+
+    spec = DATASETS[name]
+    roles = spec['ident'] + spec['quasi_ident'] + [spec['sensitive']]
+    stages = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        columnar_folder = os.path.join(tmp, 'columnar')
+        os.makedirs(columnar_folder)
+        cache = DatasetCache(memory_budget=2 ** 62, columnar_folder=columnar_folder)
+
+        with stage(stages, 'load') as record:
+            profile = cache.profile(path)
+            # Large files are only profiled; then only the columns with a role are loaded
+            if isinstance(profile, DatasetProfile):
+                dataset = cache.get(path, columns=roles)
+            else:
+                dataset = profile
+            rows = record['rows'] = len(dataset.df)
+
+        registry = HierarchyRegistry()
+        registry.load_folder('hierarchies')
+        df = dataset.df.copy(deep=False)
+        with stage(stages, 'hierarchies', rows):
+            hierarchies = pipeline.build_hierarchies(df, spec['hierarchies'], registry)
+
+        results = []
+        output_path = os.path.join(tmp, 'anonymized.csv')
+        for method, k, l_div, supp_level in grid_points(grid):
+            result = {'method': method, 'k': k, 'l_div': l_div, 'supp_level': supp_level, 'stages': {}}
+            try:
+                with stage(result['stages'], 'anonymize', rows):
+                    with pipeline.suppress_progress():
+                        anonymized = pipeline.anonymize(
+                            df, method, spec['ident'], spec['quasi_ident'], [spec['sensitive']],
+                            k, l_div, supp_level, hierarchies, engine=engine
+                        )
+                with stage(result['stages'], 'write', len(anonymized)):
+                    anonymized.to_csv(output_path, index=False)
+                result['status'] = 'ok' if len(anonymized) else 'impossible'
+                result['output_rows'] = len(anonymized)
+            except Exception as e:
+                result['status'] = 'error'
+                result['error'] = f"{type(e).__name__}: {e}"
+            results.append(result)
+
+    return {
+        'dataset': name,
+        'scale': scale,
+        'rows': rows,
+        'engine': engine,
+        'stages': stages,
+        'results': results,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def stage_times(report):
+    """
+    Seconds per (dataset, scale, engine, setting, stage) in a report.
+    """
+    times = {}
+    for run in report['runs']:
+        base = (run['dataset'], run['scale'], run['engine'])
+        for name, values in run['stages'].items():
+            times[base + ('', name)] = values['seconds']
+        for result in run['results']:
+            setting = f"{result['method']} k={result['k']} l={result['l_div']} supp={result['supp_level']}"
+            for name, values in result['stages'].items():
+                times[base + (setting, name)] = values['seconds']
+    return times
+
+
+def compare(baseline, report, tolerance, min_seconds):
+    """
+    Stages that got slower than the baseline by more than tolerance (a
+    fraction) and more than min_seconds.
+    """
+    old_times = stage_times(baseline)
+    regressions = []
+    for key, seconds in stage_times(report).items():
+        old = old_times.get(key)
+        if old is not None and seconds > old * (1 + tolerance) and seconds - old > min_seconds:
+            regressions.append({'key': list(key), 'baseline_seconds': old, 'seconds': seconds})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the anonymization workflow (load, hierarchies, anonymize, write) on the bundled datasets."
+    )
+    parser.add_argument('--datasets', nargs='+', choices=sorted(DATASETS), default=sorted(DATASETS))
+    parser.add_argument('--scales', nargs='*', type=int, default=[10, 100, 1000],
+                        help=f"scale-up factors of {SCALED_DATASET}.csv (default: 10 100 1000)")
+    parser.add_argument('--engines', nargs='+', choices=['anjana', 'native'], default=['native', 'anjana'])
+    parser.add_argument('--max-anjana-rows', type=int, default=MAX_ANJANA_ROWS,
+                        help="skip the anjana engine on datasets with more rows than this")
+    parser.add_argument('--quick', action='store_true', help="one setting per method instead of the full grid")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', metavar='BASELINE', help="earlier results to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="slowdown (fraction) tolerated before a stage counts as a regression")
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help="slowdowns smaller than this are never regressions")
+    args = parser.parse_args(argv)
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    grid = QUICK_GRID if args.quick else DEFAULT_GRID
+    jobs = [(name, DATASETS[name]['path'], 1) for name in args.datasets]
+    for factor in args.scales:
+        jobs.append((SCALED_DATASET, scaled_copy(DATASETS[SCALED_DATASET]['path'], factor), factor))
+
+    with open(DATASETS[SCALED_DATASET]['path'], 'rb') as f:
+        scaled_rows = sum(1 for _ in f) - 1
+
+    runs = []
+    # One fresh process per run so that peak RSS is measured per dataset and engine
+    context = multiprocessing.get_context('spawn')
+    for (name, path, scale), engine in itertools.product(jobs, args.engines):
+        if engine == 'anjana' and scale > 1 and scaled_rows * scale > args.max_anjana_rows:
+            print(f"skipping anjana on {name} x{scale}")
+            continue
+        print(f"running {name} x{scale} with {engine}...", flush=True)
+        with context.Pool(1) as pool:
+            run = pool.apply(run_dataset, (name, path, scale, engine, grid))
+        runs.append(run)
+        print(f"  {run['rows']} rows, load {run['stages']['load']['seconds']:.2f}s, "
+              f"anonymize {sum(r['stages'].get('anonymize', {}).get('seconds', 0) for r in run['results']):.2f}s",
+              flush=True)
+
+    report = {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'grid': grid,
+        'runs': runs,
+    }
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            report['regressions'] = compare(json.load(f), report, args.tolerance, args.min_seconds)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}")
+
+    for regression in report.get('regressions', []):
+        print(f"REGRESSION {' / '.join(str(part) for part in regression['key'] if part != '')}: "
+              f"{regression['baseline_seconds']:.3f}s -> {regression['seconds']:.3f}s")
+    return 1 if report.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+
+import ingest
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet support is optional; everything falls back to CSV
+    pa = None
+    pq = None
+
+CONVERT_CHUNK_ROWS = 100_000
+
+
+def available():
+    """
+    True when pyarrow is installed and Parquet files can be read and written.
+    """
+    return pq is not None
+
+
+def columnar_path(folder, filename, content_hash):
+    """
+    Location of the columnar copy of an upload. The content hash is part of
+    the name, so a replaced upload never reads a stale copy.
+    """
+    return os.path.join(folder, f"{filename}.{content_hash[:16]}.parquet")
+
+
+def remove_stale_copies(folder, filename, content_hash):
+    """
+    Delete the columnar copies of earlier versions of an upload.
+    """
+    current = os.path.basename(columnar_path(folder, filename, content_hash))
+    prefix, suffix = f"{filename}.", ".parquet"
+    for name in os.listdir(folder):
+        hash_part = name[len(prefix):-len(suffix)]
+        if (name != current and name.startswith(prefix) and name.endswith(suffix)
+                and len(hash_part) == 16 and all(c in '0123456789abcdef' for c in hash_part)):
+            try:
+                os.remove(os.path.join(folder, name))
+            except FileNotFoundError:
+                pass
+
+
+def _string_columns(schema):
+    return [field.name for field in schema
+            if pa.types.is_string(field.type) or pa.types.is_large_string(field.type)
+            or pa.types.is_dictionary(field.type)]
+
+
+def _write_atomically(path, write):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_dataframe(df, path):
+    """
+    Write a DataFrame as Parquet with dictionary-encoded string columns.
+    Returns False (writing nothing) if the data cannot be stored as Parquet,
+    e.g. object columns that mix strings and numbers.
+    """
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return False
+    _write_atomically(path, lambda tmp: pq.write_table(
+        table, tmp, use_dictionary=_string_columns(table.schema), compression='zstd'
+    ))
+    return True
+
+
+def convert_csv(csv_path, path, dtypes, chunksize=CONVERT_CHUNK_ROWS):
+    """
+    Convert a CSV file to Parquet chunk by chunk, with bounded memory.
+    dtypes maps every column to the dtype it is read with (as computed by
+    ingest.profile_csv), which keeps the schema identical across chunks.
+    Returns False (writing nothing) if a chunk does not fit the schema.
+    """
+    schema = pa.schema([
+        (col, pa.string() if dtype == 'object' else pa.from_numpy_dtype(np.dtype(dtype)))
+        for col, dtype in dtypes.items()
+    ])
+
+    def write(tmp_path):
+        with pq.ParquetWriter(tmp_path, schema, use_dictionary=_string_columns(schema), compression='zstd') as writer:
+            for chunk in pd.read_csv(csv_path, chunksize=chunksize, dtype=dtypes):
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+    try:
+        _write_atomically(path, write)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, ValueError):
+        return False
+    return True
+
+
+def read_columns(path, columns=None, categorical=False):
+    """
+    Read some (or all) columns of a Parquet file through a memory map.
+    With categorical=True, string columns are returned as pandas
+    categoricals decoded straight from their dictionary pages.
+    """
+    read_dictionary = None
+    if categorical:
+        schema = pq.read_schema(path)
+        wanted = schema.names if columns is None else columns
+        read_dictionary = [col for col in _string_columns(schema) if col in wanted]
+    table = pq.read_table(path, columns=columns, memory_map=True, read_dictionary=read_dictionary)
+    return table.to_pandas()
+
+
+def load_columns(path, columns=None, categorical=False):
+    """
+    Read some (or all) columns of an upload, either the CSV itself or its
+    Parquet copy, with the same values read_csv would give. With
+    categorical=True, the string columns of a Parquet copy come back as
+    categoricals (see read_columns).
+    """
+    if not path.endswith('.parquet'):
+        return pd.read_csv(path, usecols=columns)
+    df = read_columns(path, columns, categorical)
+    # Arrow nulls come back as None; read_csv gives NaN
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].fillna(np.nan)
+    return df
+
+
+def csv_to_parquet(csv_path, path):
+    """
+    Parquet copy of a CSV result file for download, rebuilt only when the CSV
+    is newer. It is converted chunk by chunk (see convert_csv), with the
+    dtypes of a first chunked pass. Raises ValueError if it cannot be stored
+    as Parquet.
+    """
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(csv_path):
+        return path
+    try:
+        dtypes = ingest.profile_csv(csv_path)['dtypes']
+    except pd.errors.EmptyDataError:
+        # anjana's empty result has no header
+        _write_atomically(path, lambda tmp: pq.write_table(pa.table({}), tmp))
+        return path
+    if not convert_csv(csv_path, path, dtypes):
+        raise ValueError("The result cannot be stored as Parquet")
+    return path
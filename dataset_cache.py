@@ -0,0 +1,336 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+import columnar
+import ingest
+from instrumentation import span
+
+# Default memory budget for parsed datasets kept in memory (bytes)
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+# Files above this size are profiled by streaming instead of being fully parsed
+DEFAULT_STREAMING_THRESHOLD = 100 * 1024 * 1024
+# Number of streamed profiles kept
+MAX_PROFILES = 32
+# String columns with at most this share of distinct values are kept as categoricals
+MAX_CATEGORY_RATIO = 0.5
+
+
+def file_content_hash(filepath):
+    """
+    Compute a SHA-256 digest of a file's content, reading it in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def profile_columns(df):
+    """
+    Infer the column profile used by the column-selection page:
+    the type of every column ("numeric" or "string") and the maximum
+    length of its string representation (used for masking).
+    """
+    col_types = {}
+    max_len_map = {}
+    for col in df.columns:
+        if pd.api.types.is_numeric_dtype(df[col]):
+            col_types[col] = "numeric"
+        else:
+            col_types[col] = "string"
+        # Lengths are computed on the distinct values only, which is the same
+        # maximum as over every cell.
+        uniques = pd.Series(df[col].unique()).astype(str)
+        max_len_map[col] = uniques.str.len().max() if len(uniques) else 0
+    return col_types, max_len_map
+
+
+def compact_dataframe(df, max_category_ratio=MAX_CATEGORY_RATIO):
+    """
+    Store a freshly parsed DataFrame with compact dtypes: integer columns are
+    downcast to the smallest integer type holding their values, and string
+    columns with few distinct values become categoricals (integer codes into
+    one copy of each distinct string). Float columns are left as they are so
+    their values, and how they are written back to CSV, do not change.
+    """
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_integer_dtype(series):
+            df[col] = pd.to_numeric(series, downcast='integer')
+        elif series.dtype == object and len(series):
+            if series.nunique(dropna=False) <= max_category_ratio * len(series):
+                df[col] = series.astype('category')
+    return df
+
+
+def _nbytes(obj):
+    """
+    Approximate memory used by arrays nested in dicts and tuples.
+    """
+    if isinstance(obj, dict):
+        return sum(_nbytes(value) for value in obj.values())
+    if isinstance(obj, (tuple, list)):
+        return sum(_nbytes(value) for value in obj)
+    return int(getattr(obj, 'nbytes', 0))
+
+
+class DatasetEntry:
+    """
+    A parsed dataset together with everything derived from it that the
+    column-selection page needs.
+    """
+
+    def __init__(self, filename, content_hash, df, source):
+        self.filename = filename
+        self.content_hash = content_hash
+        # File the data was read from (the CSV upload or its columnar copy)
+        self.source = source
+        self.df = df
+        self.columns = df.columns.tolist()
+        self.col_types, self.max_len_map = profile_columns(df)
+        self.distinct_map = {col: int(df[col].nunique(dropna=False)) for col in self.columns}
+        self.preview_html = df.head(100).to_html(classes="table table-striped", index=False)
+        self.nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        # Hierarchy levels compiled for this dataset, keyed by hierarchy definition
+        self.hierarchies = {}
+        # Memory charged for each of them
+        self.hierarchy_nbytes = {}
+
+
+class DatasetProfile:
+    """
+    Column profile and preview of a large CSV file, computed in one chunked
+    pass without loading the whole dataset.
+    """
+
+    def __init__(self, filename, content_hash, profile, preview_df):
+        self.filename = filename
+        self.content_hash = content_hash
+        self.rows = profile['rows']
+        self.columns = profile['columns']
+        self.col_types = profile['col_types']
+        self.dtypes = profile['dtypes']
+        self.max_len_map = profile['max_len_map']
+        self.distinct_map = profile['distinct_map']
+        self.preview_html = preview_df.to_html(classes="table table-striped", index=False)
+
+
+class DatasetCache:
+    """
+    LRU cache of parsed datasets keyed by filename plus content hash.
+
+    The content hash of a file is only recomputed when its size or
+    modification time changes, so a replaced upload is detected without
+    hashing the file on every request. Entries are evicted in least recently
+    used order once their total size exceeds the memory budget.
+
+    Files larger than streaming_threshold are only profiled (see profile())
+    until their full content is actually needed.
+
+    With a columnar_folder (and pyarrow installed), every upload is converted
+    once to Parquet there, and later loads read that copy instead of parsing
+    the CSV again.
+    """
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, streaming_threshold=DEFAULT_STREAMING_THRESHOLD,
+                 columnar_folder=None):
+        self.memory_budget = memory_budget
+        self.streaming_threshold = streaming_threshold
+        self.columnar_folder = columnar_folder if columnar.available() else None
+        self._entries = OrderedDict()
+        self._profiles = OrderedDict()
+        self._hashes = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def total_bytes(self):
+        """
+        Approximate memory used by the cached datasets and their hierarchies.
+        """
+        return self._total_bytes
+
+    def content_hash(self, filepath):
+        """
+        Return the content hash of a file, reusing the previous digest when
+        the file has not been modified since it was computed.
+        """
+        stat = os.stat(filepath)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            known = self._hashes.get(filepath)
+        if known and known[0] == signature:
+            return known[1]
+        digest = file_content_hash(filepath)
+        with self._lock:
+            self._hashes[filepath] = (signature, digest)
+        return digest
+
+    def remember_hash(self, filepath, digest):
+        """
+        Record the content hash of a file that was just written, e.g. computed
+        while streaming an upload to disk.
+        """
+        stat = os.stat(filepath)
+        with self._lock:
+            self._hashes[filepath] = ((stat.st_size, stat.st_mtime_ns), digest)
+
+    def profile(self, filepath):
+        """
+        Return what the column-selection page needs for a CSV file: the full
+        DatasetEntry for small files, or a DatasetProfile built by streaming
+        for files above the streaming threshold.
+        """
+        filename = os.path.basename(filepath)
+        key = (filename, self.content_hash(filepath))
+        with self._lock:
+            for cached in (self._entries, self._profiles):
+                if key in cached:
+                    cached.move_to_end(key)
+                    return cached[key]
+        if os.path.getsize(filepath) <= self.streaming_threshold:
+            return self.get(filepath)
+
+        with span('profile_csv') as record:
+            columns_profile = ingest.profile_csv(filepath)
+            record['rows'] = columns_profile['rows']
+        profile = DatasetProfile(filename, key[1], columns_profile, ingest.read_preview(filepath))
+        if self.columnar_folder:
+            path = columnar.columnar_path(self.columnar_folder, filename, key[1])
+            if not os.path.exists(path):
+                with span('convert_parquet', rows=columns_profile['rows']):
+                    columnar.convert_csv(filepath, path, columns_profile['dtypes'])
+                columnar.remove_stale_copies(self.columnar_folder, filename, key[1])
+        with self._lock:
+            for old_key in [k for k in self._profiles if k[0] == filename and k != key]:
+                del self._profiles[old_key]
+            self._profiles[key] = profile
+            while len(self._profiles) > MAX_PROFILES:
+                self._profiles.popitem(last=False)
+        return profile
+
+    def get(self, filepath, columns=None):
+        """
+        Return the DatasetEntry for a CSV file, parsing it only when it is not
+        cached yet or its content has changed. Parsing errors are propagated.
+        With columns, only those columns are loaded (and cached separately).
+        """
+        filename = os.path.basename(filepath)
+        content_hash = self.content_hash(filepath)
+        key = (filename, content_hash) if columns is None else (filename, content_hash, tuple(columns))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+
+        df, source = self._read(filepath, content_hash, columns)
+        with span('compact_dtypes', rows=len(df)):
+            df = compact_dataframe(df)
+        with span('profile_dataset', rows=len(df)):
+            entry = DatasetEntry(filename, content_hash, df, source)
+
+        with self._lock:
+            # Drop stale versions of the same file
+            for old_key in [k for k in self._entries if k[0] == filename and k[1] != content_hash]:
+                self._remove(old_key)
+            if key not in self._entries:
+                self._entries[key] = entry
+                self._total_bytes += entry.nbytes
+            self._entries.move_to_end(key)
+            self._evict()
+            return self._entries.get(key, entry)
+
+    def _read(self, filepath, content_hash, columns=None):
+        """
+        Load a CSV upload, preferring its columnar copy (memory-mapped, only
+        the requested columns). Small files get their columnar copy written on
+        first load. Returns the DataFrame and the file it was read from.
+        """
+        if self.columnar_folder:
+            path = columnar.columnar_path(self.columnar_folder, os.path.basename(filepath), content_hash)
+            if os.path.exists(path):
+                with span('read_parquet') as record:
+                    # String columns come straight from their dictionaries
+                    # as categoricals, which compact_dataframe keeps as they are
+                    df = columnar.load_columns(path, columns, categorical=True)
+                    record['rows'] = len(df)
+                return df, path
+        with span('read_csv') as record:
+            df = pd.read_csv(filepath, usecols=columns)
+            record['rows'] = len(df)
+        if self.columnar_folder and columns is None and os.path.getsize(filepath) <= self.streaming_threshold:
+            with span('write_parquet', rows=len(df)):
+                columnar.write_dataframe(df, path)
+            columnar.remove_stale_copies(self.columnar_folder, os.path.basename(filepath), content_hash)
+        return df, filepath
+
+    def hierarchy(self, entry, key, build):
+        """
+        Return the hierarchy levels (or anything else derived from the
+        dataset, such as a hierarchy plus a prepared column) cached on a
+        dataset entry under key, calling build() to compile them on first
+        use. Errors raised by build() are propagated and nothing is cached.
+        """
+        with self._lock:
+            hierarchy = entry.hierarchies.get(key)
+        if hierarchy is not None:
+            return hierarchy
+
+        with span('build_hierarchy', kind=key[0], column=key[1] if len(key) > 1 else None):
+            hierarchy = build()
+        nbytes = _nbytes(hierarchy)
+
+        with self._lock:
+            if key not in entry.hierarchies:
+                entry.hierarchies[key] = hierarchy
+                entry.hierarchy_nbytes[key] = 0
+                self._charge(entry, key, nbytes)
+            return entry.hierarchies[key]
+
+    def recharge(self, entry, key):
+        """
+        Update the memory charged for something cached by hierarchy() that
+        grows as it is used, such as an EquivalenceIndex caching the lattice
+        nodes it has visited, evicting entries if it no longer fits.
+        """
+        with self._lock:
+            hierarchy = entry.hierarchies.get(key)
+            if hierarchy is not None:
+                self._charge(entry, key, _nbytes(hierarchy))
+
+    def _charge(self, entry, key, nbytes):
+        growth = nbytes - entry.hierarchy_nbytes[key]
+        entry.hierarchy_nbytes[key] = nbytes
+        entry.nbytes += growth
+        if any(e is entry for e in self._entries.values()):
+            self._total_bytes += growth
+            self._evict()
+
+    def source(self, filepath):
+        """
+        File the data of a CSV upload is best loaded from: its columnar copy
+        when there is one (named after the content, so it cannot change under
+        a job reading it), else the upload itself.
+        """
+        if self.columnar_folder:
+            path = columnar.columnar_path(self.columnar_folder, os.path.basename(filepath),
+                                          self.content_hash(filepath))
+            if os.path.exists(path):
+                return path
+        return filepath
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._total_bytes -= entry.nbytes
+
+    def _evict(self):
+        # Always keep the most recently used entry, even if it alone exceeds the budget
+        while self._total_bytes > self.memory_budget and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
@@ -0,0 +1,301 @@
+import numpy as np
+import pandas as pd
+
+from hierarchy_builders import factorize
+
+# Outcomes of a plan
+OK = 'ok'
+IMPOSSIBLE = 'impossible'  # anjana gives up and returns an empty result
+ERROR = 'error'  # anjana raises an exception
+
+
+def _first_positions(codes, size):
+    """
+    First position of every code 0..size-1 in an array of codes.
+    """
+    first = np.zeros(size, dtype=np.intp)
+    first[codes[::-1]] = np.arange(len(codes))[::-1]
+    return first
+
+
+def _group(keys):
+    """
+    Group the rows of a 2-D array of non-negative integer codes.
+    Returns the group of every row and the distinct rows, in order of
+    first appearance.
+    """
+    if keys.shape[1] == 0 or len(keys) == 0:
+        return np.zeros(len(keys), dtype=np.intp), keys[:1]
+    radix = keys.max(axis=0).astype(np.float64) + 1
+    if np.prod(radix) < 2 ** 62:
+        # Mixed-radix encoding of every row into a single int64
+        combined = np.zeros(len(keys), dtype=np.int64)
+        for j in range(keys.shape[1]):
+            combined = combined * int(radix[j]) + keys[:, j]
+        codes, _ = pd.factorize(combined)
+    else:
+        codes = pd.DataFrame(keys).groupby(list(range(keys.shape[1])), sort=False).ngroup().to_numpy()
+    return codes, keys[_first_positions(codes, codes.max() + 1)]
+
+
+class QuasiIdentifierLevels:
+    """
+    Integer codes of one quasi-identifier and their mapping through the
+    levels of its hierarchy.
+
+    up[L] maps the code of a value at level 0 to the code of the value it
+    takes at level L. Like anjana's apply_hierarchy, each step looks the
+    current value up (first position) in the previous level and takes the
+    value at the same position in the next one. missing[L] flags the
+    level-L codes that are NaN, which pandas leaves out of every group.
+    """
+
+    def __init__(self, values, levels):
+        self.codes, uniques = factorize(values)
+        # Without a hierarchy anjana fails as soon as it tries to generalize the column
+        self.has_hierarchy = levels is not None
+        if levels is None:
+            levels = {0: uniques}
+        self.num_levels = len(levels) - 1
+
+        level_codes, level_uniques = factorize(np.asarray(levels[0], dtype=object))
+        lookup = pd.Index(level_uniques).get_indexer(uniques)
+        # Values missing from level 0 make anjana fail when generalizing the column
+        self.complete = bool((lookup >= 0).all())
+        positions = _first_positions(level_codes, len(level_uniques))[np.where(lookup >= 0, lookup, 0)]
+
+        self.up = [np.arange(len(uniques))]
+        self.values = [uniques]
+        self.missing = [np.asarray(pd.isna(uniques), dtype=bool)]
+        for lvl in range(1, self.num_levels + 1):
+            level_codes, level_uniques = factorize(np.asarray(levels[lvl], dtype=object))
+            # Code at level lvl of every code at level lvl - 1, composed from level 0
+            self.up.append(level_codes[positions][self.up[-1]])
+            self.values.append(level_uniques)
+            self.missing.append(np.asarray(pd.isna(level_uniques), dtype=bool))
+            positions = _first_positions(level_codes, len(level_uniques))
+
+    def generalize(self, level, rows=None):
+        """
+        Values of the column at a level (for the given row positions only, if any).
+        """
+        codes = self.codes if rows is None else self.codes[rows]
+        return self.values[level][self.up[level][codes]]
+
+
+class EquivalenceIndex:
+    """
+    Equivalence classes of a dataset for one set of quasi-identifiers and
+    hierarchies, at every node of the generalization lattice.
+
+    The rows are grouped once, at level 0, into base classes with their
+    sizes and the counts of every sensitive value in them. The classes of
+    any other node (one hierarchy level per quasi-identifier) are unions of
+    base classes, so they are computed from those counts without touching
+    the rows again, and cached per node.
+
+    plan() replays the search anjana runs for k-anonymity and l-diversity on
+    these counts, so the outcome of new k, l and suppression values is known
+    before anything is anonymized.
+    """
+
+    def __init__(self, df, quasi_ident, hierarchies, sens_att=None, executor=None):
+        self.quasi_ident = list(quasi_ident)
+        self.sens_att = sens_att
+        self.rows = len(df)
+        # The quasi-identifiers are encoded independently, on the executor if one is given
+        encode = lambda qi: QuasiIdentifierLevels(df[qi], hierarchies.get(qi))
+        self.levels = list(executor.map(encode, self.quasi_ident) if executor else map(encode, self.quasi_ident))
+
+        codes = np.column_stack([lv.codes for lv in self.levels]) if self.levels else np.empty((self.rows, 0), np.intp)
+        self.base_of_row, self.base_keys = _group(codes)
+        self.base_sizes = np.bincount(self.base_of_row, minlength=len(self.base_keys))
+
+        self.pair_base = self.pair_sens = self.pair_counts = None
+        if sens_att is not None:
+            sens_codes, _ = factorize(df[sens_att])
+            pair_of_row, pairs = _group(np.column_stack([self.base_of_row, sens_codes]))
+            self.pair_base, self.pair_sens = pairs[:, 0], pairs[:, 1]
+            self.pair_counts = np.bincount(pair_of_row, minlength=len(pairs))
+        self._nodes = {}
+
+    @property
+    def nbytes(self):
+        arrays = [self.base_of_row, self.base_keys, self.base_sizes, self.pair_base, self.pair_sens, self.pair_counts]
+        arrays += [a for lv in self.levels for a in [lv.codes] + lv.up + lv.values + lv.missing]
+        # (a copy of the nodes, which another thread may be adding to)
+        arrays += [a for node in list(self._nodes.values()) for a in node]
+        return sum(a.nbytes for a in arrays if a is not None)
+
+    def node(self, levels):
+        """
+        Classes at a lattice node given as one level per quasi-identifier.
+        Returns the class of every base class and whether each class is
+        left out of the grouping because of a NaN value.
+        """
+        levels = tuple(levels)
+        cached = self._nodes.get(levels)
+        if cached is None:
+            keys = np.column_stack([
+                lv.up[lvl][self.base_keys[:, j]] for j, (lv, lvl) in enumerate(zip(self.levels, levels))
+            ]) if self.levels else self.base_keys
+            class_of_base, class_keys = _group(keys)
+            dropped = np.zeros(len(class_keys), dtype=bool)
+            for j, (lv, lvl) in enumerate(zip(self.levels, levels)):
+                dropped |= lv.missing[lvl][class_keys[:, j]]
+            cached = self._nodes[levels] = (class_of_base, dropped)
+        return cached
+
+    def stats(self, levels, kept=None):
+        """
+        Sizes and numbers of distinct sensitive values of the classes at a
+        node, counting only the base classes selected by the boolean mask
+        kept (all of them by default). Empty classes and classes with NaN
+        values are left out, as in pandas' groupby.
+        """
+        class_of_base, dropped = self.node(levels)
+        weights = self.base_sizes if kept is None else np.where(kept, self.base_sizes, 0)
+        sizes = np.bincount(class_of_base, weights=weights, minlength=len(dropped)).astype(np.int64)
+        present = (sizes > 0) & ~dropped
+        diversity = None
+        if self.pair_base is not None:
+            pair_class = class_of_base[self.pair_base]
+            pairs = np.column_stack([pair_class, self.pair_sens])
+            if kept is not None:
+                pairs = pairs[kept[self.pair_base]]
+            _, distinct_pairs = _group(pairs)
+            diversity = np.bincount(distinct_pairs[:, 0], minlength=len(dropped))[present]
+        return sizes[present], diversity
+
+    def distinct(self, j, level, kept=None):
+        """
+        Number of distinct values of quasi-identifier j at a level.
+        """
+        codes = self.base_keys[:, j] if kept is None else self.base_keys[kept, j]
+        return len(np.unique(self.levels[j].up[level][codes]))
+
+    def suppressed_bases(self, levels, k):
+        """
+        Mask of the base classes that fall in classes smaller than k at a node.
+        """
+        class_of_base, dropped = self.node(levels)
+        sizes = np.bincount(class_of_base, weights=self.base_sizes, minlength=len(dropped))
+        return ((sizes < k) & ~dropped)[class_of_base]
+
+    def _generalize(self, levels, active, kept=None):
+        """
+        One generalization step of anjana: the active quasi-identifier with
+        most distinct values goes up one level, or leaves the active list if
+        it is already at its top level. Returns an error message if anjana
+        would raise instead.
+        """
+        j = active[int(np.argmax([self.distinct(a, levels[a], kept) for a in active]))]
+        lv = self.levels[j]
+        if not lv.has_hierarchy:
+            return f"No hierarchy for quasi-identifier {self.quasi_ident[j]}"
+        if not lv.complete:
+            return f"Some values of {self.quasi_ident[j]} are not in its hierarchy"
+        if levels[j] + 1 > lv.num_levels:
+            active.remove(j)
+        else:
+            levels[j] += 1
+        return None
+
+    def kept_rows(self, suppressed):
+        """
+        Positions of the rows outside the suppressed base classes.
+        """
+        return np.flatnonzero(~suppressed[self.base_of_row])
+
+    def _plan_k(self, k, supp_level):
+        levels = [0] * len(self.levels)
+        active = list(range(len(self.levels)))
+        while True:
+            sizes, _ = self.stats(levels)
+            if len(sizes) == 0:
+                return ERROR, levels, None, "No equivalence classes (every row has a missing value)"
+            if sizes.min() >= k:
+                return OK, levels, None, None
+            if k <= sizes.max():
+                if sizes[sizes < k].sum() * 100 / self.rows <= supp_level:
+                    return OK, levels, self.suppressed_bases(levels, k), None
+            if not active:
+                return IMPOSSIBLE, levels, None, f"k-anonymity cannot be achieved for k={k}"
+            error = self._generalize(levels, active)
+            if error:
+                return ERROR, levels, None, error
+
+    def _plan_l(self, k, l_div, supp_level):
+        status, levels, suppressed, message = self._plan_k(k, supp_level)
+        if status != OK:
+            # anjana's l-diversity fails on the empty result of k-anonymity
+            return ERROR if status == IMPOSSIBLE else status, levels, suppressed, message
+        kept = None if suppressed is None else ~suppressed
+        supp_records = 0 if suppressed is None else int(self.base_sizes[suppressed].sum())
+
+        _, diversity = self.stats(levels, kept)
+        if len(diversity) == 0:
+            return ERROR, levels, suppressed, "No equivalence classes left after k-anonymity"
+        active = list(range(len(self.levels)))
+        while diversity.min() < l_div:
+            if l_div > diversity.max():
+                # anjana then suppresses every class and fails on the empty result
+                sizes, _ = self.stats(levels, kept)
+                if (sizes.sum() + supp_records) * 100 / self.rows <= supp_level:
+                    return ERROR, levels, suppressed, "Every equivalence class would be suppressed"
+            if not active:
+                return IMPOSSIBLE, levels, suppressed, f"l-diversity cannot be achieved for l={l_div}"
+            error = self._generalize(levels, active, kept)
+            if error:
+                return ERROR, levels, suppressed, error
+            _, diversity = self.stats(levels, kept)
+        return OK, levels, suppressed, None
+
+    def search(self, method, k, supp_level, l_div=None):
+        """
+        Run anjana's search on the cached counts. Returns the status (OK,
+        IMPOSSIBLE or ERROR), the level reached by every quasi-identifier,
+        the mask of suppressed base classes (None if nothing is suppressed)
+        and a message explaining a failure. Invalid settings are an ERROR,
+        with anjana's message.
+        """
+        error = None
+        if k < 1:
+            error = f"Invalid value of k for k-anonymity k={k}"
+        elif supp_level > 100 or supp_level < 0:
+            error = f"Invalid value of for the suppression level {supp_level}"
+        elif method == "l_diversity" and l_div < 1:
+            error = f"Invalid value of l for l-diversity l={l_div}"
+        if error:
+            return ERROR, [0] * len(self.levels), None, error
+        if method == "l_diversity":
+            return self._plan_l(k, l_div, supp_level)
+        return self._plan_k(k, supp_level)
+
+    def plan(self, method, k, supp_level, l_div=None):
+        """
+        Outcome of anonymizing with the given settings: the status, the
+        hierarchy level chosen for every quasi-identifier, the number of
+        suppressed records and the k (and l) the result reaches.
+        """
+        status, levels, suppressed, message = self.search(method, k, supp_level, l_div)
+        kept = None if suppressed is None else ~suppressed
+        supp_records = 0 if suppressed is None else int(self.base_sizes[suppressed].sum())
+        sizes, diversity = self.stats(levels, kept)
+        result = {
+            'status': status,
+            'message': message,
+            'levels': {
+                qi: (lvl if lv.has_hierarchy else None)
+                for qi, lv, lvl in zip(self.quasi_ident, self.levels, levels)
+            },
+            'max_levels': {qi: lv.num_levels for qi, lv in zip(self.quasi_ident, self.levels)},
+            'rows': self.rows,
+            'suppressed': supp_records,
+            'suppressed_percent': supp_records * 100 / self.rows if self.rows else 0.0,
+            'classes': int(len(sizes)),
+            'k': int(sizes.min()) if len(sizes) else None,
+        }
+        if diversity is not None:
+            result['l'] = int(diversity.min()) if len(diversity) else None
+        return result
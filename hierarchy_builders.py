@@ -0,0 +1,183 @@
+import numpy as np
+import pandas as pd
+
+# Value used when a data value has no entry in a hierarchy
+NOT_MAPPED = " not able to map"
+
+
+def factorize(values):
+    """
+    Encode a column as integer codes into its distinct values, listed in
+    order of first appearance. Missing values get a code of their own
+    instead of a sentinel. Categorical columns reuse their codes instead of
+    hashing every value again.
+    """
+    if isinstance(values, pd.Series):
+        values = values.array
+    if isinstance(values, pd.Categorical):
+        categories = np.append(np.asarray(values.categories, dtype=object), np.nan)
+        # -1 (missing) selects the trailing NaN category
+        raw_codes = np.where(values.codes < 0, len(categories) - 1, values.codes)
+        first_seen = pd.unique(raw_codes)
+        remap = np.empty(len(categories), dtype=np.intp)
+        remap[first_seen] = np.arange(len(first_seen))
+        return remap[raw_codes], categories[first_seen]
+    codes, uniques = pd.factorize(pd.Series(values), use_na_sentinel=False)
+    return codes, np.asarray(uniques, dtype=object)
+
+
+def compact_levels(uniques, tables):
+    """
+    Assemble a hierarchy from per-category lookup tables.
+
+    Level 0 lists the distinct values of the column and tables[lvl - 1] the
+    value each of them takes at level lvl. anjana only needs the levels to be
+    aligned with each other (it looks a value up in one level and reads the
+    same position in the next), so one entry per distinct value is enough and
+    the hierarchy's size does not depend on the number of rows. Listing the
+    values in order of first appearance keeps the result identical to
+    row-aligned levels, even for hierarchies that are not strict trees.
+    """
+    hierarchy = {0: uniques}
+    for lvl, table in enumerate(tables, start=1):
+        hierarchy[lvl] = table
+    return hierarchy
+
+
+def interval_tables(uniques, inf, sup, steps):
+    """
+    Lookup tables generalizing numeric categories into "[lower, upper)" intervals,
+    one table per step. Mirrors anjana's utils.generate_intervals.
+    """
+    uniques = np.asarray(uniques)
+    tables = []
+    for step in steps:
+        bounds = np.arange(inf, sup + 1, step)
+        upper = np.searchsorted(bounds, uniques)
+        upper[upper == 0] = 1
+        lowers, uppers = bounds[upper - 1], bounds[upper]
+        tables.append(np.array([f"[{lo}, {up})" for lo, up in zip(lowers, uppers)], dtype=object))
+    return tables
+
+
+# Alignments of the masking hierarchies (see masking_tables)
+MASKING_ALIGNMENTS = ("right", "left")
+_MASK = ord("*")
+
+
+def _integer_characters(numbers):
+    """
+    Characters of the decimal representation of integers as a matrix of code
+    points (one row per number, left-aligned and padded with 0) and their
+    lengths, computed digit by digit without converting the numbers to text.
+    """
+    numbers = np.asarray(numbers, dtype=np.int64)
+    negative = numbers < 0
+    magnitude = np.abs(numbers).astype(np.uint64)
+    digits = np.ones(len(numbers), dtype=np.int64)
+    power = np.uint64(10)
+    for _ in range(19):
+        digits += magnitude >= power
+        if power > np.iinfo(np.uint64).max // 10:
+            break
+        power *= np.uint64(10)
+    lengths = digits + negative
+    width = int(lengths.max()) if len(numbers) else 0
+    chars = np.zeros((len(numbers), width), dtype=np.uint32)
+    chars[negative, 0] = ord("-")
+    rows = np.arange(len(numbers))
+    for position in range(int(digits.max()) if len(numbers) else 0):
+        has = digits > position
+        chars[rows[has], lengths[has] - 1 - position] = ord("0") + (magnitude[has] % np.uint64(10)).astype(np.uint32)
+        magnitude //= np.uint64(10)
+    return chars, lengths
+
+
+def _string_characters(strings):
+    """
+    Code points of strings as a fixed-width matrix (left-aligned, padded
+    with 0) and their lengths.
+    """
+    fixed = np.asarray(strings, dtype=str)
+    width = max(fixed.dtype.itemsize // 4, 1)
+    chars = fixed.reshape(-1).astype(f"U{width}").view(np.uint32).reshape(len(fixed), width)
+    return chars.copy(), np.count_nonzero(chars, axis=1)
+
+
+def masking_tables(uniques, max_level=None, align="right"):
+    """
+    Lookup tables masking the categories with "*" one more character per
+    level, one table per level 1..max_level (by default the length of the
+    longest category, where every category is fully masked).
+
+    The categories are laid out once as a fixed-width matrix of characters
+    (integers digit by digit, without a round trip through text) and each
+    level only stars one more character per row of it:
+
+    - align="right" hides the last lvl characters of every category; those
+      with at most lvl characters become lvl stars.
+    - align="left" lines the categories up on their first character and
+      hides the last lvl positions of the longest one: a category keeps its
+      first (width - lvl) characters and is padded with stars to the width,
+      or is kept as is if it is not longer than that.
+
+    Both give the same levels when all categories have the same length.
+    """
+    if align not in MASKING_ALIGNMENTS:
+        raise ValueError(f"Unknown masking alignment {align!r} (expected one of {', '.join(MASKING_ALIGNMENTS)})")
+    uniques = np.asarray(uniques, dtype=object)
+    if len(uniques) and pd.api.types.infer_dtype(uniques, skipna=False) == "integer":
+        chars, lengths = _integer_characters(uniques.astype(np.int64))
+    else:
+        chars, lengths = _string_characters(pd.Series(uniques, dtype=object).astype(str).to_numpy())
+    longest = int(lengths.max()) if len(uniques) else 0
+    if max_level is None:
+        max_level = longest
+    width = max(longest, max_level)
+    if width > chars.shape[1]:
+        chars = np.pad(chars, ((0, 0), (0, width - chars.shape[1])))
+    rows = np.arange(len(uniques))
+    tables = []
+    for lvl in range(1, max_level + 1):
+        if align == "right":
+            # Position of the lvl-th character from the end, or past the
+            # stars when the category is already fully masked
+            chars[rows, np.where(lengths >= lvl, lengths - lvl, lvl - 1)] = _MASK
+        else:
+            cut = width - lvl
+            if cut >= 0:
+                # Categories masked already lose one more character; those
+                # reaching the cut are starred up to the width (at the top
+                # level, empty ones too)
+                reached = lengths == cut + 1 if cut > 0 else lengths <= 1
+                chars[lengths > cut + 1, cut] = _MASK
+                chars[np.ix_(reached, np.arange(cut, width))] = _MASK
+        tables.append(chars.view(f"U{width}").reshape(-1).astype(object))
+    return tables
+
+
+def masking_hierarchy(values, max_level=None, align="right"):
+    """
+    Build a masking hierarchy where each level masks one more character
+    (see masking_tables).
+    """
+    _, uniques = factorize(values)
+    return compact_levels(uniques, masking_tables(uniques, max_level, align))
+
+
+def column_masking_hierarchy(values, align="right"):
+    """
+    Masking hierarchy for a column, with one level per character of its
+    longest value. Integer columns are masked on their digits and kept as
+    they are; other columns are replaced by their stripped strings, returned
+    with the hierarchy (as a categorical), since those are what its level 0
+    refers to.
+    """
+    codes, uniques = factorize(values)
+    if len(uniques) and pd.api.types.infer_dtype(uniques, skipna=False) == "integer":
+        return masking_hierarchy(values, align=align), values
+    stripped = pd.Series(uniques, dtype=object).astype(str).str.strip()
+    # Different raw values may strip to the same string
+    stripped_codes, stripped_uniques = factorize(stripped.to_numpy(dtype=object))
+    column = pd.Categorical.from_codes(stripped_codes[codes], categories=pd.Index(stripped_uniques, dtype=object))
+    return masking_hierarchy(column, align=align), column
@@ -0,0 +1,164 @@
+import csv
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from hierarchy_builders import NOT_MAPPED, compact_levels, factorize, interval_tables
+
+
+class MappingHierarchy:
+    """
+    Hierarchy given as one row per original value: value, level1, level2, ...
+    (the format ARX uses for its hierarchy CSV files).
+
+    The rows are compiled once into a value -> row index and a
+    (rows + 1) x levels table; the extra last row holds NOT_MAPPED for
+    values that are not in the hierarchy, so generalizing a dataset only
+    needs one index per distinct value.
+    """
+
+    kind = "mapping"
+
+    def __init__(self, name, rows):
+        self.name = name
+        rows = [list(row) for row in rows if len(row) > 0]
+        self.num_levels = max((len(row) for row in rows), default=1) - 1
+        # Later rows override earlier ones for the same value
+        self.index = {row[0]: pos for pos, row in enumerate(rows)}
+        self.table = np.full((len(rows) + 1, self.num_levels), NOT_MAPPED, dtype=object)
+        for pos, row in enumerate(rows):
+            self.table[pos, :len(row) - 1] = row[1:]
+        self.fingerprint = hashlib.sha256(
+            json.dumps([self.kind, rows]).encode("utf-8")
+        ).hexdigest()
+
+    @classmethod
+    def from_text(cls, name, text):
+        """
+        Parse the comma-separated format of the custom hierarchy textarea,
+        ignoring lines with a single value.
+        """
+        rows = []
+        for line in text.splitlines():
+            if line.strip():
+                parts = [p.strip() for p in line.split(',')]
+                if len(parts) > 1:
+                    rows.append(parts)
+        return cls(name, rows)
+
+    def tables(self, uniques):
+        """
+        Per-level lookup tables for the given distinct values (matched by their string form).
+        """
+        pos = np.fromiter((self.index.get(str(u), -1) for u in uniques), dtype=np.intp, count=len(uniques))
+        return [self.table[pos, lvl] for lvl in range(self.num_levels)]
+
+    def build(self, values):
+        """
+        Build all the levels of the hierarchy for a column, as lookup tables
+        over its distinct values (see hierarchy_builders.compact_levels).
+        """
+        _, uniques = factorize(values)
+        return compact_levels(uniques, self.tables(uniques))
+
+
+class IntervalHierarchy:
+    """
+    Numeric hierarchy generalizing values into "[lower, upper)" intervals,
+    with one level per step size.
+    """
+
+    kind = "interval"
+
+    def __init__(self, name, inf, sup, steps):
+        self.name = name
+        self.inf = inf
+        self.sup = sup
+        self.steps = list(steps)
+        self.num_levels = len(self.steps)
+        self.fingerprint = hashlib.sha256(
+            json.dumps([self.kind, inf, sup, self.steps]).encode("utf-8")
+        ).hexdigest()
+
+    def tables(self, uniques):
+        return interval_tables(uniques, self.inf, self.sup, self.steps)
+
+    def build(self, values):
+        _, uniques = factorize(values)
+        return compact_levels(uniques, self.tables(uniques))
+
+
+def load_hierarchy_file(filepath):
+    """
+    Load a hierarchy definition named after the file it is stored in.
+
+    - .csv: ARX-style rows "value;level1;level2;..." (";" or "," separated)
+    - .json: {"type": "interval", "min": 0, "max": 100, "steps": [5, 10]}
+             or {"type": "mapping", "rows": [["value", "level1", ...], ...]}
+    """
+    name, ext = os.path.splitext(os.path.basename(filepath))
+    ext = ext.lower()
+    if ext == '.csv':
+        with open(filepath, newline='', encoding='utf-8') as f:
+            sample = f.readline()
+            f.seek(0)
+            delimiter = ';' if ';' in sample else ','
+            rows = [[p.strip() for p in row] for row in csv.reader(f, delimiter=delimiter)]
+        return MappingHierarchy(name, rows)
+    if ext == '.json':
+        with open(filepath, encoding='utf-8') as f:
+            spec = json.load(f)
+        if spec.get("type") == "interval":
+            return IntervalHierarchy(name, spec["min"], spec["max"], spec["steps"])
+        if spec.get("type") == "mapping":
+            return MappingHierarchy(name, spec["rows"])
+        raise ValueError(f"Unknown hierarchy type in {filepath}: {spec.get('type')}")
+    raise ValueError(f"Unsupported hierarchy file: {filepath}")
+
+
+class HierarchyRegistry:
+    """
+    Named, precompiled hierarchy definitions.
+    """
+
+    def __init__(self):
+        self._hierarchies = {}
+
+    def register(self, hierarchy):
+        self._hierarchies[hierarchy.name] = hierarchy
+
+    def load_folder(self, folder):
+        """
+        Load every .csv/.json hierarchy definition in a folder.
+        """
+        if not os.path.isdir(folder):
+            return
+        for entry in sorted(os.listdir(folder)):
+            if os.path.splitext(entry)[1].lower() in ('.csv', '.json'):
+                self.register(load_hierarchy_file(os.path.join(folder, entry)))
+
+    def get(self, name):
+        return self._hierarchies.get(name)
+
+    def names(self):
+        return sorted(self._hierarchies)
+
+    def __contains__(self, name):
+        return name in self._hierarchies
+
+
+# Registries loaded by load_registry, one per folder and process
+_registries = {}
+
+
+def load_registry(folder):
+    """
+    Registry of the hierarchies in a folder, loaded once per process.
+    """
+    registry = _registries.get(folder)
+    if registry is None:
+        registry = _registries[folder] = HierarchyRegistry()
+        registry.load_folder(folder)
+    return registry
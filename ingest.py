@@ -0,0 +1,99 @@
+import hashlib
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+PROFILE_CHUNK_ROWS = 100_000
+# Distinct values tracked per column while profiling; above this the count is a lower bound
+MAX_TRACKED_DISTINCT = 100_000
+
+
+def save_upload(file, filepath, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Write an uploaded file to disk chunk by chunk, hashing it on the way.
+    The data goes to a temporary file that replaces filepath once complete,
+    so a half-written upload never shadows the previous version.
+    Returns the SHA-256 digest of the content.
+    """
+    digest = hashlib.sha256()
+    tmp_path = f"{filepath}.{uuid.uuid4().hex}.part"
+    try:
+        with open(tmp_path, 'wb') as out:
+            for chunk in iter(lambda: file.stream.read(chunk_size), b''):
+                digest.update(chunk)
+                out.write(chunk)
+        os.replace(tmp_path, filepath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return digest.hexdigest()
+
+
+def read_preview(filepath, nrows=100):
+    """
+    Parse only the first rows of a CSV file.
+    """
+    return pd.read_csv(filepath, nrows=nrows)
+
+
+def profile_csv(filepath, chunksize=PROFILE_CHUNK_ROWS, max_distinct=MAX_TRACKED_DISTINCT):
+    """
+    Profile every column of a CSV file in one chunked pass with bounded memory.
+
+    Returns a dict with the row count, the column names and, per column, the
+    type ("numeric" only if every chunk parsed as numeric), the pandas dtype
+    to read it with, the maximum length of its string representation and the
+    number of distinct values (capped at max_distinct, see "distinct_exact").
+    """
+    columns = None
+    rows = 0
+    numeric = {}
+    chunk_dtypes = {}
+    max_len_map = {}
+    distinct = {}
+    for chunk in pd.read_csv(filepath, chunksize=chunksize):
+        if columns is None:
+            columns = chunk.columns.tolist()
+            numeric = {col: True for col in columns}
+            chunk_dtypes = {col: set() for col in columns}
+            max_len_map = {col: 0 for col in columns}
+            distinct = {col: set() for col in columns}
+        rows += len(chunk)
+        for col in columns:
+            series = chunk[col]
+            if not pd.api.types.is_numeric_dtype(series):
+                numeric[col] = False
+            chunk_dtypes[col].add(series.dtype)
+            uniques = series.unique()
+            lengths = pd.Series(uniques).astype(str).str.len()
+            if len(lengths):
+                max_len_map[col] = max(max_len_map[col], int(lengths.max()))
+            seen = distinct[col]
+            if len(seen) <= max_distinct:
+                seen.update(uniques[:max_distinct + 1 - len(seen)])
+
+    if columns is None:
+        # Header only: let pandas report the columns
+        columns = pd.read_csv(filepath, nrows=0).columns.tolist()
+        numeric = {col: False for col in columns}
+        max_len_map = {col: 0 for col in columns}
+        distinct = {col: set() for col in columns}
+
+    dtypes = {}
+    for col in columns:
+        if numeric[col]:
+            dtypes[col] = np.result_type(*chunk_dtypes[col]).name
+        else:
+            dtypes[col] = 'object'
+    return {
+        'rows': rows,
+        'columns': columns,
+        'col_types': {col: "numeric" if numeric[col] else "string" for col in columns},
+        'dtypes': dtypes,
+        'max_len_map': max_len_map,
+        'distinct_map': {col: min(len(distinct[col]), max_distinct) for col in columns},
+        'distinct_exact': {col: len(distinct[col]) <= max_distinct for col in columns},
+    }
@@ -0,0 +1,244 @@
+import contextlib
+import contextvars
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:  # Current RSS is optional; peak RSS comes from resource
+    psutil = None
+
+logger = logging.getLogger('anonymizer')
+
+# Histogram buckets (seconds) for stage, request and job durations
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# Histogram buckets for the row counts of the stages
+ROW_BUCKETS = (10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+
+# Spans recorded by span() in the current request or job, if any
+_spans = contextvars.ContextVar('spans', default=None)
+
+
+def current_rss():
+    """
+    Resident set size of this process in bytes, or None without psutil.
+    """
+    if psutil is None:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes, or None.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms with labels, rendered in the Prometheus
+    text exposition format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (type, help)
+        self._meta = {}
+        # name -> {labels: value}
+        self._values = {}
+        # name -> buckets
+        self._buckets = {}
+
+    def _declare(self, name, kind, help_text, buckets=None):
+        if name not in self._meta:
+            self._meta[name] = (kind, help_text)
+            self._values[name] = {}
+            if buckets is not None:
+                self._buckets[name] = tuple(buckets) + (math.inf,)
+
+    def inc(self, name, help_text, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._declare(name, 'counter', help_text)
+            self._values[name][key] = self._values[name].get(key, 0) + amount
+
+    def set_max(self, name, help_text, value, **labels):
+        """
+        Gauge keeping the largest value seen.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._declare(name, 'gauge', help_text)
+            self._values[name][key] = max(self._values[name].get(key, value), value)
+
+    def observe(self, name, help_text, value, buckets=DURATION_BUCKETS, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._declare(name, 'histogram', help_text, buckets)
+            bounds = self._buckets[name]
+            counts, total = self._values[name].get(key, ([0] * len(bounds), 0.0))
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[name][key] = (counts, total + value)
+
+    def render(self, extra_gauges=()):
+        """
+        All metrics in the Prometheus text format. extra_gauges are
+        (name, help, value) triples computed at scrape time.
+        """
+        lines = []
+        with self._lock:
+            for name in sorted(self._meta):
+                kind, help_text = self._meta[name]
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for key, value in sorted(self._values[name].items()):
+                    if kind != 'histogram':
+                        lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+                        continue
+                    counts, total = value
+                    for bound, count in zip(self._buckets[name], counts):
+                        lines.append(f'{name}_bucket{_format_labels(key + (("le", _format_value(bound)),))} {count}')
+                    lines.append(f'{name}_sum{_format_labels(key)} {_format_value(total)}')
+                    lines.append(f'{name}_count{_format_labels(key)} {counts[-1]}')
+        for name, help_text, value in extra_gauges:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of this process (the web process exports them on /metrics)
+metrics = Metrics()
+
+
+def record_span(record):
+    """
+    Add a finished span (as produced by span()) to the process metrics.
+    """
+    stage = record['stage']
+    metrics.observe('anonymizer_stage_duration_seconds', 'Wall time of pipeline stages.',
+                    record['seconds'], stage=stage)
+    if record.get('rows') is not None:
+        metrics.observe('anonymizer_stage_rows', 'Rows processed by pipeline stages.',
+                        record['rows'], buckets=ROW_BUCKETS, stage=stage)
+    if record.get('peak_rss_bytes') is not None:
+        metrics.set_max('anonymizer_stage_peak_rss_bytes',
+                        'Largest peak RSS of the process running a stage, at the end of the stage.',
+                        record['peak_rss_bytes'], stage=stage, process=record.get('process', 'web'))
+
+
+@contextlib.contextmanager
+def span(stage, rows=None, **attributes):
+    """
+    Time a pipeline stage and record its memory use and row count.
+
+    The span is logged (as JSON, on the "anonymizer" logger at DEBUG level),
+    added to the metrics of this process unless collect_spans() is active,
+    and appended to the spans being collected for the current request or
+    job. The row count can also be set inside the block, as record['rows'].
+    """
+    record = {'stage': stage, 'rows': rows, **attributes}
+    rss_before = current_rss()
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException:
+        record['error'] = True
+        raise
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        rss_after = current_rss()
+        if rss_after is not None:
+            record['rss_bytes'] = rss_after
+            record['rss_delta_bytes'] = rss_after - rss_before
+        record['peak_rss_bytes'] = peak_rss()
+        spans = _spans.get()
+        if spans is not None:
+            spans.append(record)
+        if spans is None or not spans.deferred:
+            record_span(record)
+        logger.debug(json.dumps({'event': 'span', **record}, default=str))
+
+
+class SpanList(list):
+    """
+    Spans of one request or job. Deferred lists are not added to the metrics
+    of the process that records them: a worker process returns them to the
+    web process, which records them there.
+    """
+
+    def __init__(self, deferred=False):
+        super().__init__()
+        self.deferred = deferred
+
+
+@contextlib.contextmanager
+def collect_spans(deferred=False):
+    """
+    Collect the spans recorded inside the block into a list.
+    """
+    spans = SpanList(deferred)
+    token = _spans.set(spans)
+    try:
+        yield spans
+    finally:
+        _spans.reset(token)
+
+
+def start_request_spans():
+    """
+    Start collecting spans for the current request (see finish_request_spans).
+    """
+    return _spans.set(SpanList())
+
+
+def finish_request_spans(token):
+    spans = _spans.get()
+    _spans.reset(token)
+    return spans or []
+
+
+def configure_logging():
+    """
+    Send the instrumentation log to stderr when ANONYMIZER_LOG_LEVEL is set
+    (e.g. DEBUG to log every span).
+    """
+    level = os.environ.get('ANONYMIZER_LOG_LEVEL')
+    if level and not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(level.upper())
@@ -0,0 +1,231 @@
+import multiprocessing
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+# Progress queue of the current worker process, set by _init_worker
+_progress_queue = None
+
+
+class QueueFull(Exception):
+    """
+    Raised when a job is submitted while the queue is at capacity.
+    """
+
+
+def _init_worker(progress_queue):
+    global _progress_queue
+    _progress_queue = progress_queue
+
+
+def _run(job_id, fn, args):
+    """
+    Entry point in the worker process: runs fn(*args, report=...) where
+    report(stage, fraction) sends progress updates back to the web process.
+    """
+    def report(stage, fraction):
+        if _progress_queue is not None:
+            _progress_queue.put((job_id, stage, fraction))
+
+    report("running", 0.0)
+    return fn(*args, report=report)
+
+
+class Job:
+    def __init__(self, job_id, description, context=None):
+        self.id = job_id
+        self.description = description
+        # Submitter data kept with the job for on_finish (never sent to the worker)
+        self.context = context or {}
+        self.status = QUEUED
+        self.stage = QUEUED
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.future = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'description': self.description,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': self.progress,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class JobManager:
+    """
+    Runs anonymization jobs on a process pool so that web workers only submit
+    work and poll for its state.
+
+    At most max_workers jobs run at once and at most max_pending more wait
+    in the queue; submitting beyond that raises QueueFull. Queued jobs can be
+    cancelled; a running job cannot be interrupted, so cancelling it only
+    discards its result. The pool is started on first use.
+
+    on_finish, if given, is called with every job once it is done, failed
+    or cancelled (e.g. to record metrics).
+    """
+
+    def __init__(self, max_workers=None, max_pending=8, max_finished=200, on_finish=None):
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self.on_finish = on_finish
+        self._jobs = OrderedDict()
+        # Reentrant: cancelling a future runs its done callback synchronously
+        self._lock = threading.RLock()
+        self._executor = None
+        self._progress_queue = None
+
+    def _ensure_started(self):
+        if self._progress_queue is None:
+            self._progress_queue = multiprocessing.Queue()
+            threading.Thread(target=self._drain_progress, daemon=True).start()
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                initializer=_init_worker,
+                initargs=(self._progress_queue,)
+            )
+
+    def _discard_pool(self, executor):
+        # A worker died (e.g. killed for running out of memory): the pool
+        # fails all its jobs and accepts no more, so the next submit starts a new one
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def _drain_progress(self):
+        while True:
+            try:
+                job_id, stage, fraction = self._progress_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                return
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is not None and job.status not in FINISHED_STATES:
+                    if job.started is None:
+                        job.started = time.time()
+                    job.status = RUNNING
+                    job.stage = stage
+                    job.progress = fraction
+
+    def active_count(self):
+        """
+        Jobs queued or running, including cancelled jobs still running on a worker.
+        """
+        with self._lock:
+            return sum(1 for job in self._jobs.values()
+                       if job.status not in FINISHED_STATES or not job.future.done())
+
+    def submit(self, fn, *args, description='', context=None):
+        """
+        Queue fn(*args, report=...) for execution and return the job id.
+        fn and args must be picklable. context is kept as job.context.
+        """
+        with self._lock:
+            self._ensure_started()
+            if self.active_count() >= self.max_workers + self.max_pending:
+                raise QueueFull("Too many anonymization jobs are queued, please try again later.")
+            job = Job(uuid.uuid4().hex, description, context)
+            executor = self._executor
+            try:
+                job.future = executor.submit(_run, job.id, fn, args)
+            except BrokenProcessPool:
+                # Broken before the failed jobs reported it
+                self._discard_pool(executor)
+                self._ensure_started()
+                executor = self._executor
+                job.future = executor.submit(_run, job.id, fn, args)
+            self._jobs[job.id] = job
+            self._prune()
+        job.future.add_done_callback(lambda future, job=job: self._finish(job, future, executor))
+        return job.id
+
+    def _finish(self, job, future, executor):
+        broken = not future.cancelled() and isinstance(future.exception(), BrokenProcessPool)
+        if broken:
+            self._discard_pool(executor)
+        with self._lock:
+            if job.status == CANCELLED:
+                # Already reported by cancel()
+                return
+            job.finished = time.time()
+            try:
+                job.result = future.result()
+                job.status = DONE
+                job.stage = DONE
+                job.progress = 1.0
+            except CancelledError:
+                job.status = CANCELLED
+            except BrokenProcessPool:
+                job.status = FAILED
+                job.stage = FAILED
+                job.error = "The worker process stopped unexpectedly (e.g. it ran out of memory)"
+            except Exception as e:
+                job.status = FAILED
+                job.stage = FAILED
+                job.error = str(e)
+        self._notify(job)
+
+    def _notify(self, job):
+        if self.on_finish is not None:
+            self.on_finish(job)
+
+    def _prune(self):
+        # Forget the oldest finished jobs beyond max_finished (cancelled jobs once their worker is done)
+        finished = [job_id for job_id, job in self._jobs.items()
+                    if job.status in FINISHED_STATES and job.future.done()]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancel a job. Returns False if the job is unknown or already finished.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED_STATES:
+                return False
+            # Marked first: cancelling a queued future runs _finish right away
+            job.status = CANCELLED
+            job.stage = CANCELLED
+            job.finished = time.time()
+            job.future.cancel()
+        self._notify(job)
+        return True
+
+    def shutdown(self, wait=True):
+        """
+        Stop the pool, dropping queued jobs.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,76 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from equivalence_index import ERROR, IMPOSSIBLE, EquivalenceIndex
+
+
+def _check_columns(data, ident, quasi_ident, sens_att=None):
+    for i in ident:
+        if i not in data.columns:
+            raise ValueError(f"Identifier {i} is not a column in the given dataset")
+    for qi in quasi_ident:
+        if qi not in data.columns:
+            raise ValueError(f"Quasi-identifier {qi} is not a column in the given dataset")
+    if sens_att is not None and sens_att not in data.columns:
+        raise ValueError(f"Sensitive attribute {sens_att} is not a column in the given dataset")
+
+
+def _anonymize(data, ident, quasi_ident, sens_att, method, k, l_div, supp_level, hierarchies, workers):
+    """
+    anjana generalizes one quasi-identifier at a time and regroups every row
+    after each step. Here the quasi-identifiers are encoded once as integer
+    codes (one thread per column), each lattice node on anjana's path is
+    checked with a group-by count over the equivalence-class index, and the
+    rows are only touched again to write the result.
+    """
+    _check_columns(data, ident, quasi_ident, sens_att)
+
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        index = EquivalenceIndex(data, quasi_ident, hierarchies, sens_att, executor=executor)
+        status, levels, suppressed, message = index.search(method, k, supp_level, l_div)
+        if status == IMPOSSIBLE:
+            return pd.DataFrame()
+        if status == ERROR:
+            raise ValueError(message)
+
+        rows = None if suppressed is None else index.kept_rows(suppressed)
+        generalized = dict(zip(quasi_ident, executor.map(
+            lambda j: index.levels[j].generalize(levels[j], rows) if levels[j] > 0 else None,
+            range(len(quasi_ident))
+        )))
+
+    columns = {}
+    for col in data.columns:
+        if col in ident:
+            columns[col] = np.full(len(data) if rows is None else len(rows), "*", dtype=object)
+        elif generalized.get(col) is not None:
+            columns[col] = generalized[col]
+        else:
+            values = data[col].array
+            columns[col] = values if rows is None else values.take(rows)
+    result = pd.DataFrame(columns, index=data.index if rows is None else data.index[rows])
+    if rows is not None:
+        # anjana drops the suppressed records and resets the index, keeping the old one as a column
+        result = result.reset_index()
+    return result
+
+
+def k_anonymity(data, ident, quasi_ident, k, supp_level, hierarchies, workers=None):
+    """
+    Anonymize a dataset using k-anonymity (same parameters and result as
+    anjana.anonymity.k_anonymity). workers is the number of threads used to
+    encode and generalize the quasi-identifiers (default: number of CPUs).
+    """
+    return _anonymize(data, ident, quasi_ident, None, "k_anonymity", k, None, supp_level, hierarchies, workers)
+
+
+def l_diversity(data, ident, quasi_ident, sens_att, k, l_div, supp_level, hierarchies, workers=None):
+    """
+    Anonymize a dataset using l-diversity (same parameters and result as
+    anjana.anonymity.l_diversity).
+    """
+    return _anonymize(data, ident, quasi_ident, sens_att, "l_diversity", k, l_div, supp_level, hierarchies, workers)
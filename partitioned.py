@@ -0,0 +1,368 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import pipeline
+from dataset_cache import compact_dataframe
+from hierarchy_registry import load_registry
+from result_files import ChunkedCSVWriter, write_csv
+
+DEFAULT_PARTITION_ROWS = 1_000_000
+DEFAULT_CHUNK_ROWS = 200_000
+# Successful partitions kept back from the output, for a failing last partition to merge with
+HELD_PARTITIONS = 8
+
+
+def _column_kind(texts):
+    """
+    "int", "float" or "object": the dtype read_csv infers for these (non-null) texts.
+    """
+    if len(texts) == 0:
+        return "int"
+    numbers = pd.to_numeric(pd.Series(texts, dtype=object), errors="coerce")
+    if numbers.isna().any():
+        return "object"
+    return "int" if pd.api.types.is_integer_dtype(numbers) else "float"
+
+
+def _merge_kinds(kind, other):
+    if "object" in (kind, other):
+        return "object"
+    return "float" if "float" in (kind, other) else "int"
+
+
+class PartitionScan:
+    """
+    First pass over a CSV file, one chunk at a time: the number of rows of
+    every distinct combination of quasi-identifier (and sensitive) values,
+    and the dtype read_csv would infer for every column of the whole file.
+    Its memory depends on the number of distinct combinations, not of rows.
+    """
+
+    def __init__(self, path, quasi_ident, sens_att=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+        self.quasi_ident = list(quasi_ident)
+        self.sens_att = sens_att
+        keys = self.quasi_ident + ([sens_att] if sens_att else [])
+        kinds = {}
+        has_nan = {}
+        counts = []
+        pending = 0
+        self.rows = 0
+        # Everything is read as text: the counts are keyed by the values as written
+        for chunk in pd.read_csv(path, dtype=str, chunksize=chunk_rows):
+            self.rows += len(chunk)
+            for col in chunk.columns:
+                values = chunk[col]
+                has_nan[col] = has_nan.get(col, False) or bool(values.isna().any())
+                if kinds.get(col) != "object":
+                    kind = _column_kind(values.dropna().unique())
+                    kinds[col] = _merge_kinds(kinds.get(col, "int"), kind)
+            counts.append(chunk.groupby(keys, dropna=False, sort=False).size())
+            pending += len(counts[-1])
+            # Keep the partial counts about as small as the distinct combinations
+            if pending > 4 * chunk_rows:
+                counts = [self._combine(counts)]
+                pending = len(counts[0])
+        self.columns = list(kinds)
+        self.counts = self._combine(counts) if counts else pd.Series(dtype=np.int64)
+
+        # The dtypes read_csv infers for the whole file, so that every partition
+        # is read (and written back) like the complete dataset would be
+        self.dtypes = {}
+        for col, kind in kinds.items():
+            if kind == "int" and not has_nan[col]:
+                self.dtypes[col] = np.int64
+            elif kind in ("int", "float"):
+                self.dtypes[col] = np.float64
+            else:
+                self.dtypes[col] = object
+
+    def _combine(self, counts):
+        combined = pd.concat(counts)
+        return combined.groupby(level=list(range(combined.index.nlevels)), dropna=False, sort=False).sum()
+
+
+def _value_order(column, values, spec, registry):
+    """
+    Distinct text values of a quasi-identifier in the order the partitions
+    split them: numerically for numbers, otherwise grouped by the values they
+    generalize to (top level first) so that a partition tends to hold whole
+    branches of the hierarchy. Missing values come last.
+    """
+    values = pd.Series(values, dtype=object).dropna().drop_duplicates()
+    numbers = pd.to_numeric(values, errors="coerce")
+    if len(values) and not numbers.isna().any():
+        return values.to_numpy()[np.argsort(numbers.to_numpy(), kind="stable")]
+    keys = [values.astype(str).to_numpy()]
+    if spec.get("type") in ("custom", "file", "default"):
+        df = pd.DataFrame({column: values.to_numpy()})
+        levels = pipeline.build_hierarchies(df, {column: spec}, registry)[column]
+        keys += [np.asarray(levels[lvl], dtype=str) for lvl in range(1, len(levels))]
+    # np.lexsort sorts by its last key (the top level) first
+    return values.to_numpy()[np.lexsort(keys)]
+
+
+class Partitioning:
+    """
+    Mondrian-style partitioning of a scanned file: the quasi-identifier
+    space is split recursively at the (row-weighted) median of the widest
+    quasi-identifier until every partition has at most partition_rows rows.
+    A split is only made if both halves keep at least k rows (and l distinct
+    sensitive values), so every partition can be anonymized on its own.
+    """
+
+    def __init__(self, scan, k, partition_rows, l_div=None, hierarchies=None, registry=None):
+        self.quasi_ident = scan.quasi_ident
+        counts = scan.counts
+        index = counts.index.to_frame(index=False)
+        self.orders = []
+        ranks = np.empty((len(counts), len(self.quasi_ident)), dtype=np.int64)
+        for j, qi in enumerate(self.quasi_ident):
+            order = _value_order(qi, index[qi], (hierarchies or {}).get(qi, {}), registry)
+            self.orders.append(pd.Index(order, dtype=object))
+            rank = self.orders[j].get_indexer(index[qi])
+            # Missing values rank after every value
+            ranks[:, j] = np.where(rank >= 0, rank, len(order))
+        weights = counts.to_numpy()
+        widths = np.array([len(order) + 1 for order in self.orders])
+        # Rows with a missing quasi-identifier are in no equivalence class, so
+        # they do not count towards k (a partition of only those would fail)
+        counted = np.where((ranks < widths - 1).all(axis=1), weights, 0)
+        sens = pd.factorize(index[scan.sens_att])[0] if scan.sens_att and l_div else None
+
+        self.oversized = 0
+        groups = []
+        stack = [np.arange(len(counts))]
+        while stack:
+            members = stack.pop()
+            halves = None
+            if weights[members].sum() > partition_rows:
+                halves = self._split(ranks, widths, weights, counted, sens, members, k, l_div)
+            if halves is None:
+                if weights[members].sum() > partition_rows:
+                    self.oversized += 1
+                groups.append(members)
+            else:
+                # Right half pushed first, so partitions come out in rank order
+                stack.extend(reversed(halves))
+
+        # Partition of every distinct quasi-identifier combination
+        keys = pd.MultiIndex.from_arrays([ranks[:, j] for j in range(len(self.quasi_ident))])
+        partition_of = np.empty(len(counts), dtype=np.int64)
+        self.sizes = []
+        for pid, members in enumerate(groups):
+            partition_of[members] = pid
+            self.sizes.append(int(weights[members].sum()))
+        unique = ~keys.duplicated()
+        self._keys = keys[unique]
+        self._partition_of = partition_of[unique]
+
+    @staticmethod
+    def _split(ranks, widths, weights, counted, sens, members, k, l_div):
+        # Quasi-identifiers from the widest range (relative to its domain) down
+        spans = (ranks[members].max(axis=0) - ranks[members].min(axis=0)) / widths
+        for j in np.argsort(-spans, kind="stable"):
+            if spans[j] == 0:
+                break
+            column = ranks[members, j]
+            order = np.argsort(column, kind="stable")
+            cumulative = np.cumsum(weights[members][order])
+            median = column[order][np.searchsorted(cumulative, cumulative[-1] / 2)]
+            left = column <= median
+            if left.all():
+                left = column < median
+            halves = (members[left], members[~left])
+            if any(counted[half].sum() < k for half in halves):
+                continue
+            if sens is not None and any(len(np.unique(sens[half][counted[half] > 0])) < l_div for half in halves):
+                continue
+            return halves
+        return None
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def assign(self, chunk):
+        """
+        Partition of every row of a chunk read as text.
+        """
+        ranks = []
+        for qi, order in zip(self.quasi_ident, self.orders):
+            rank = order.get_indexer(chunk[qi])
+            ranks.append(np.where(rank >= 0, rank, len(order)))
+        return self._partition_of[self._keys.get_indexer(pd.MultiIndex.from_arrays(ranks))]
+
+
+def _anonymize_partition(paths, result_path, dtypes, columns, settings):
+    """
+    Anonymize one partition (in a worker process), read from one or more
+    partition files, and write the result without header to result_path.
+    """
+    df = pd.concat([pd.read_csv(path, dtype=dtypes) for path in paths], ignore_index=True)
+    df = compact_dataframe(df)
+    registry = load_registry(settings["hierarchy_folder"])
+    specs = {col: spec for col, spec in settings["hierarchies"].items() if col in df.columns}
+    hierarchies = pipeline.build_hierarchies(df, specs, registry)
+    try:
+        with pipeline.suppress_progress():
+            anonymized = pipeline.anonymize(
+                df, settings["method"], settings["ident"], settings["quasi_ident"], settings["sens_att_list"],
+                settings["k"], settings["l_div"], settings["supp_level"], hierarchies, engine=settings["engine"]
+            )
+    except ValueError as e:
+        # Both engines raise instead of returning an empty result in some
+        # impossible cases (e.g. l-diversity); the partition is merged as well
+        return {"rows": len(df), "output_rows": 0, "status": "impossible", "error": str(e)}
+    if anonymized.empty:
+        return {"rows": len(df), "output_rows": 0, "status": "impossible"}
+    # Row positions within a partition mean nothing in the merged result
+    with ChunkedCSVWriter(result_path, columns, header=False, index=False) as writer:
+        writer.write(anonymized[columns])
+    return {"rows": len(df), "output_rows": len(anonymized), "status": "ok", "offsets": writer.offsets}
+
+
+def _append(writer, result_path, result):
+    writer.append(result_path, result["output_rows"], result["offsets"])
+    os.remove(result_path)
+
+
+def anonymize_partitioned(path, output_path, method, ident, quasi_ident, sens_att, k, l_div, supp_level,
+                          hierarchies, engine=pipeline.DEFAULT_ENGINE, hierarchy_folder="hierarchies",
+                          partition_rows=DEFAULT_PARTITION_ROWS, workers=None, chunk_rows=DEFAULT_CHUNK_ROWS,
+                          spill_dir=None, compression=None):
+    """
+    Anonymize a CSV file that does not fit in memory.
+
+    The file is read twice, in chunks: once to count the rows of every
+    quasi-identifier combination and split the quasi-identifier space into
+    partitions of at most partition_rows rows (see Partitioning), then to
+    write every row to its partition's file. The partitions are anonymized
+    independently in worker processes, with the usual hierarchies (specs as
+    in pipeline.build_hierarchies) and engine, and appended to output_path
+    in partition order as they finish, compressed with gzip or zstd if
+    compression is given (see result_files.ChunkedCSVWriter).
+
+    Every equivalence class of the result lies inside one partition, so k
+    (and l) hold for the whole file, and each partition suppresses at most
+    supp_level percent of its rows, so the whole file does too. Peak memory
+    depends on the partition size and the number of workers rather than on
+    the file. The rows come out grouped by partition, and suppressed rows
+    are not reported through anjana's "index" column.
+
+    A partition that cannot be anonymized on its own is merged with the
+    next ones (or, at the end, with up to HELD_PARTITIONS previous ones). If
+    that fails too the result is empty, as with anjana, or the engine's
+    error is raised if it raised one. Returns a dict with the output path, the row
+    count, the partition sizes, the number of merged partitions and the
+    instrumentation spans of the stages.
+    """
+    if k < 1:
+        raise ValueError(f"Invalid value of k for k-anonymity k={k}")
+    settings = {
+        "method": method, "ident": list(ident), "quasi_ident": list(quasi_ident),
+        "sens_att_list": [sens_att] if sens_att else [], "k": k, "l_div": l_div, "supp_level": supp_level,
+        "hierarchies": hierarchies, "engine": engine, "hierarchy_folder": hierarchy_folder,
+    }
+    # Partition files go next to the output by default: they are as large as
+    # the input, which a RAM-backed temporary folder may not hold
+    spill_dir = spill_dir or os.path.dirname(os.path.abspath(output_path))
+    with instrumentation.collect_spans() as spans, \
+            tempfile.TemporaryDirectory(prefix="partitions-", dir=spill_dir) as tmp:
+        with instrumentation.span("partition_scan") as record:
+            scan = PartitionScan(path, quasi_ident, sens_att if method == "l_diversity" else None, chunk_rows)
+            record["rows"] = scan.rows
+        if scan.rows == 0:
+            raise ValueError(f"{path} has no rows")
+        missing = [col for col in settings["ident"] + settings["quasi_ident"] + settings["sens_att_list"]
+                   if col not in scan.columns]
+        if missing:
+            raise ValueError(f"Columns not in {path}: {', '.join(missing)}")
+        with instrumentation.span("partition_split", rows=len(scan.counts)):
+            partitioning = Partitioning(scan, k, partition_rows, l_div if method == "l_diversity" else None,
+                                        hierarchies, load_registry(hierarchy_folder))
+
+        parts = [os.path.join(tmp, f"part-{pid}.csv") for pid in range(len(partitioning))]
+        with instrumentation.span("partition_write", rows=scan.rows, partitions=len(parts)):
+            for chunk in pd.read_csv(path, dtype=str, chunksize=chunk_rows):
+                pids = partitioning.assign(chunk)
+                for pid, rows in chunk.groupby(pids, sort=False):
+                    header = not os.path.exists(parts[pid])
+                    rows.to_csv(parts[pid], mode="a", index=False, header=header)
+
+        results = [os.path.join(tmp, f"result-{pid}.csv") for pid in range(len(parts))]
+        merged = 0
+        impossible = False
+        with instrumentation.span("anonymize_partitions", rows=scan.rows, engine=engine,
+                                  workers=workers or os.cpu_count() or 1) as record:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            writer = ChunkedCSVWriter(output_path, scan.columns, compression)
+            try:
+                run = lambda sources, result_path: executor.submit(
+                    _anonymize_partition, sources, result_path, scan.dtypes, scan.columns, settings
+                )
+                tasks = [run([part], result_path) for part, result_path in zip(parts, results)]
+
+                # A partition can fail on its own where the whole file would
+                # not (e.g. its rows to suppress exceed its share of supp_level):
+                # it is merged with the next ones until they succeed together.
+                # The last HELD_PARTITIONS successful results are only appended
+                # later, so that failing partitions at the end can be merged
+                # with 1, 2, 4... of them.
+                held = []
+                carry = []
+                result = None
+                for pid, task in enumerate(tasks):
+                    sources = carry + [parts[pid]]
+                    if carry:
+                        # The result file of the partition alone may still be being written
+                        results[pid] = os.path.join(tmp, f"result-{pid}-merged.csv")
+                    result = run(sources, results[pid]).result() if carry else task.result()
+                    if result["status"] != "ok":
+                        carry = sources
+                        merged += 1
+                        continue
+                    held.append((sources, results[pid], result))
+                    carry = []
+                    if len(held) > HELD_PARTITIONS:
+                        _append(writer, *held.pop(0)[1:])
+                count = 1
+                while carry and count <= len(held):
+                    sources = [source for entry in held[-count:] for source in entry[0]] + carry
+                    result_path = os.path.join(tmp, f"result-last-{count}-merged.csv")
+                    result = run(sources, result_path).result()
+                    if result["status"] == "ok":
+                        for entry in held[-count:]:
+                            os.remove(entry[1])
+                        held[-count:] = [(sources, result_path, result)]
+                        carry = []
+                    count *= 2
+                impossible = bool(carry)
+                if not impossible:
+                    for entry in held:
+                        _append(writer, *entry[1:])
+            except BaseException:
+                writer.abort()
+                raise
+            finally:
+                executor.shutdown(cancel_futures=True)
+            if impossible:
+                writer.abort()
+                if result.get("error"):
+                    raise ValueError(result["error"])
+                write_csv(pd.DataFrame(), output_path, compression)
+            else:
+                writer.close()
+            output_rows = record["output_rows"] = 0 if impossible else writer.rows
+
+    return {
+        "output_path": output_path,
+        "rows": output_rows,
+        "partitions": partitioning.sizes,
+        "merged_partitions": merged,
+        "oversized_partitions": partitioning.oversized,
+        "spans": list(spans),
+    }
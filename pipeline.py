@@ -0,0 +1,212 @@
+import cProfile
+import contextlib
+import io
+
+import numpy as np
+import pandas as pd
+
+import columnar
+import hierarchy_builders
+import instrumentation
+import native_engine
+import result_files
+from dataset_cache import compact_dataframe
+from hierarchy_registry import MappingHierarchy, load_hierarchy_file, load_registry
+
+# Anonymization engines: anjana itself or the built-in equivalent
+ENGINES = ('anjana', 'native')
+DEFAULT_ENGINE = 'anjana'
+
+
+def suppress_progress():
+    """
+    Context manager discarding the progress messages anjana prints to stdout,
+    where they would clutter the output of the batch and benchmark tools.
+    """
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def anonymize(df, method, ident, quasi_ident, sens_att_list, k, l_div, supp_level, hierarchies, engine=DEFAULT_ENGINE):
+    """
+    Run the chosen anonymization method on a DataFrame and return the anonymized DataFrame.
+    engine is "anjana" or "native" (the built-in implementation in native_engine,
+    which gives the same result).
+    """
+    if engine == "native":
+        if method == "l_diversity":
+            return native_engine.l_diversity(
+                df, ident, quasi_ident, sens_att_list[0], k, l_div, supp_level, hierarchies
+            )
+        return native_engine.k_anonymity(df, ident, quasi_ident, k, supp_level, hierarchies)
+
+    # Imported here so that the built-in engine (e.g. from the batch CLI) starts without it
+    import anjana.anonymity as anonymity
+
+    # anjana converts hierarchy levels in place, so it gets its own copies
+    # of the (possibly cached) hierarchy dictionaries.
+    hierarchies = {
+        col: {lvl: np.asarray(level) for lvl, level in levels.items()}
+        for col, levels in hierarchies.items()
+    }
+    # anjana assigns plain values into the columns and only accepts ndarrays
+    # as hierarchy input, so categorical columns are decoded here, in the worker.
+    categorical = [col for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)]
+    if categorical:
+        df = df.copy(deep=False)
+        for col in categorical:
+            df[col] = np.asarray(df[col], dtype=object)
+
+    if method == "l_diversity":
+        return anonymity.l_diversity(
+            data=df,
+            ident=ident,
+            quasi_ident=quasi_ident,
+            sens_att=sens_att_list[0],
+            k=k,
+            l_div=l_div,
+            supp_level=supp_level,
+            hierarchies=hierarchies
+        )
+    return anonymity.k_anonymity(
+        data=df,
+        ident=ident,
+        quasi_ident=quasi_ident,
+        k=k,
+        supp_level=supp_level,
+        hierarchies=hierarchies
+    )
+
+
+def build_hierarchies(df, specs, registry):
+    """
+    Build hierarchies without the web form, from specs mapping a column to
+    {"type": "masking" | "default" | "custom" | "file" | "none", ...}, the
+    hierarchy types of the configuration page: "default" takes the registry
+    entry given by "name" (the column name by default), "custom" the
+    hierarchy written in "text" (one "value,level1,level2" line per value)
+    or given as "rows" (lists of values), "file" a hierarchy file at "path"
+    (see hierarchy_registry.load_hierarchy_file), "masking" masks values of
+    different lengths as given by "align" ("right" by default, or "left").
+    Masked text columns are replaced in df by their stripped strings, as the
+    masking hierarchy expects. Raises ValueError like the form does.
+    """
+    hierarchies = {}
+    for col, spec in specs.items():
+        kind = spec.get("type", "none")
+        if kind == "masking":
+            hierarchies[col], df[col] = hierarchy_builders.column_masking_hierarchy(
+                df[col], spec.get("align", "right")
+            )
+        elif kind == "custom" and spec.get("rows"):
+            hierarchies[col] = MappingHierarchy(col, spec["rows"]).build(df[col])
+        elif kind == "custom" and spec.get("text"):
+            hierarchies[col] = MappingHierarchy.from_text(col, spec["text"]).build(df[col])
+        elif kind == "file":
+            hierarchies[col] = load_hierarchy_file(spec["path"]).build(df[col])
+        elif kind == "default":
+            registered = registry.get(spec.get("name", col))
+            if registered is None:
+                raise ValueError(f"Unknown hierarchy {spec.get('name', col)!r} for column {col}")
+            hierarchies[col] = registered.build(df[col])
+        else:
+            hierarchies[col] = {0: df[col].values}
+    return hierarchies
+
+
+def restore_columns(anonymized_df, source, columns):
+    """
+    Add back the columns of the original dataset that were not loaded for the
+    anonymization (they have no role, so they are passed through unchanged).
+
+    anjana keeps the row order and, when it suppresses records, records the
+    original row position in an "index" column, which is used to pick the
+    matching rows. The columns end up in the order anjana would have given
+    for the full dataset.
+    """
+    missing = [col for col in columns if col not in anonymized_df.columns]
+    if not missing or anonymized_df.empty:
+        return anonymized_df
+    restored = columnar.load_columns(source, missing)
+    if 'index' in anonymized_df.columns and 'index' not in columns:
+        positions = anonymized_df['index'].to_numpy()
+    else:
+        positions = np.arange(len(anonymized_df))
+    result = anonymized_df.copy(deep=False)
+    for col in missing:
+        result[col] = restored[col].to_numpy()[positions]
+    extra = [col for col in anonymized_df.columns if col not in columns]
+    return result[extra + list(columns)]
+
+
+def run_anonymization(params, output_path, passthrough=None, profile_path=None, report=None, compression=None):
+    """
+    Full anonymization run: anonymize, write the result as CSV to output_path
+    (in chunks, with a row index for paginated previews, or compressed with
+    "gzip" or "zstd"; see result_files) and render the 100-row preview.
+
+    params holds the keyword arguments of anonymize(). report, if given, is
+    called as report(stage, fraction) when a stage starts. passthrough, if
+    given, is a (source file, all columns) pair used to restore the columns
+    that params['df'] leaves out. With profile_path, the run is profiled
+    with cProfile and the stats are written there.
+    Returns a dict with the output path, the preview HTML, the row count and
+    the instrumentation spans of the stages (recorded by the caller, since
+    this usually runs in a worker process).
+    """
+    profiler = cProfile.Profile() if profile_path else None
+    with instrumentation.collect_spans(deferred=True) as spans:
+        if profiler:
+            profiler.enable()
+        try:
+            if report:
+                report("anonymizing", 0.05)
+            with instrumentation.span('anonymize', rows=len(params['df']), engine=params.get('engine', DEFAULT_ENGINE)):
+                anonymized_df = anonymize(**params)
+            if passthrough:
+                with instrumentation.span('restore_columns', rows=len(anonymized_df)):
+                    anonymized_df = restore_columns(anonymized_df, *passthrough)
+
+            if report:
+                report("writing", 0.8)
+            with instrumentation.span('write_csv', rows=len(anonymized_df)):
+                result_files.write_csv(anonymized_df, output_path, compression)
+
+            if report:
+                report("rendering", 0.95)
+            with instrumentation.span('render_preview', rows=min(len(anonymized_df), 100)):
+                preview_html = anonymized_df.head(100).to_html(classes="table table-striped", index=False)
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(profile_path)
+    return {
+        'output_path': output_path,
+        'preview_html': preview_html,
+        'rows': len(anonymized_df),
+        'spans': list(spans),
+        'profile_path': profile_path,
+    }
+
+
+def run_anonymization_from_source(source, columns, specs, hierarchy_folder, params, output_path, passthrough=None,
+                                  profile_path=None, report=None):
+    """
+    run_anonymization for a job given where its data is rather than the data
+    itself, so that loading and building hierarchies happen in the worker:
+    the columns of the upload (or its columnar copy) at source are loaded,
+    all of them with columns=None, and the hierarchies of specs are built with
+    the registry of hierarchy_folder (see build_hierarchies). params holds the
+    other keyword arguments of anonymize().
+    """
+    if report:
+        report("loading", 0.0)
+    with instrumentation.collect_spans(deferred=True) as spans:
+        with instrumentation.span('load_dataset') as record:
+            df = compact_dataframe(columnar.load_columns(source, columns, categorical=True))
+            record['rows'] = len(df)
+        with instrumentation.span('build_hierarchies', columns=len(specs)):
+            hierarchies = build_hierarchies(df, specs, load_registry(hierarchy_folder))
+    result = run_anonymization({**params, 'df': df, 'hierarchies': hierarchies}, output_path, passthrough,
+                               profile_path, report)
+    result['spans'] = list(spans) + result['spans']
+    return result
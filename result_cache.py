@@ -0,0 +1,148 @@
+import contextlib
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the threads of one process are serialized
+    fcntl = None
+
+# Default size bound of the stored results (1 GB)
+DEFAULT_MAX_BYTES = 1024 ** 3
+# Files of results never committed (failed or cancelled jobs) are removed after this long
+ORPHAN_SECONDS = 24 * 3600
+
+_KEY_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+
+def result_key(content_hash, config):
+    """
+    Key of a result: SHA-256 of the content hash of the input and of the
+    normalized settings of the run (a dict of JSON values).
+    """
+    payload = json.dumps({'input': content_hash, 'config': config}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def is_key(value):
+    return bool(_KEY_PATTERN.fullmatch(value))
+
+
+class ResultCache:
+    """
+    Anonymized results stored on disk under their result_key, so running the
+    same settings on the same data again is served from the stored output.
+
+    An entry is the CSV result <key>.csv written by the job (with its row
+    index and, once downloaded as Parquet, <key>.parquet) and the metadata
+    <key>.json written by commit() when the job is done; only committed
+    entries are served. When the files exceed max_bytes, the entries served
+    least recently are evicted. Files are replaced atomically, and changes
+    to the folder are serialized across threads and, with fcntl, across the
+    processes sharing it.
+    """
+
+    def __init__(self, folder, max_bytes=DEFAULT_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.folder, '.lock'), 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def path(self, key):
+        """
+        CSV result of an entry; the job anonymizing it writes it there.
+        """
+        return os.path.join(self.folder, f"{key}.csv")
+
+    def parquet_path(self, key):
+        return os.path.join(self.folder, f"{key}.parquet")
+
+    def _meta_path(self, key):
+        return os.path.join(self.folder, f"{key}.json")
+
+    def get(self, key):
+        """
+        Metadata of a committed result, or None. Marks it as recently used.
+        """
+        if not is_key(key):
+            return None
+        meta_path = self._meta_path(key)
+        with self._locked():
+            try:
+                with open(meta_path, encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                return None
+            if not os.path.isfile(self.path(key)):
+                return None
+            os.utime(meta_path)
+        return meta
+
+    def commit(self, key, meta):
+        """
+        Record the metadata of a result whose CSV has been written, making
+        it available to get(), then evict other entries down to max_bytes.
+        """
+        meta_path = self._meta_path(key)
+        tmp_path = f"{meta_path}.{uuid.uuid4().hex}.part"
+        with self._locked():
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, meta_path)
+            self._evict(keep=key)
+
+    def _entries(self):
+        # key -> [bytes, last use (None if uncommitted), newest file time, paths]
+        entries = {}
+        for name in os.listdir(self.folder):
+            key = name[:64]
+            if not is_key(key):
+                continue
+            path = os.path.join(self.folder, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entry = entries.setdefault(key, [0, None, 0, []])
+            entry[0] += stat.st_size
+            entry[2] = max(entry[2], stat.st_mtime)
+            entry[3].append(path)
+            if name == f"{key}.json":
+                entry[1] = stat.st_mtime
+        return entries
+
+    def _evict(self, keep=None):
+        entries = self._entries()
+        total = sum(entry[0] for entry in entries.values())
+        now = time.time()
+        stale = [key for key, entry in entries.items() if entry[1] is None and entry[2] < now - ORPHAN_SECONDS]
+        committed = sorted((entry[1], key) for key, entry in entries.items() if entry[1] is not None and key != keep)
+        for key in stale + [key for _, key in committed]:
+            if key not in stale and total <= self.max_bytes:
+                break
+            for path in entries[key][3]:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+            total -= entries[key][0]
+
+    @property
+    def total_bytes(self):
+        return sum(entry[0] for entry in self._entries().values())
@@ -0,0 +1,214 @@
+import bisect
+import gzip
+import json
+import os
+import uuid
+import zlib
+
+import pandas as pd
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional; gzip always works
+    zstandard = None
+
+# A byte offset is kept for every INDEX_STRIDE rows of a result
+INDEX_STRIDE = 1000
+STREAM_BLOCK_SIZE = 64 * 1024
+# File extension of every compression
+COMPRESSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def compression_available(compression):
+    return compression == 'gzip' or (compression == 'zstd' and zstandard is not None)
+
+
+def check_compression(compression):
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression!r} (expected one of {', '.join(COMPRESSIONS)})")
+    if not compression_available(compression):
+        raise ValueError(f"{compression} compression requires the zstandard package")
+
+
+def open_output(path, compression=None):
+    """
+    Binary file for writing path, compressing on the fly with gzip or zstd if asked.
+    """
+    if compression is None:
+        return open(path, 'wb')
+    check_compression(compression)
+    if compression == 'gzip':
+        return gzip.open(path, 'wb')
+    return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+
+
+def index_path(path):
+    """
+    Sidecar file with the byte offsets of the rows of a CSV result.
+    """
+    return f"{path}.index.json"
+
+
+class ChunkedCSVWriter:
+    """
+    Write a CSV result DataFrame by DataFrame, as it is produced, with the
+    same bytes DataFrame.to_csv(index=False) would give for the whole.
+
+    The file is written under a temporary name and moved into place on
+    close(). Uncompressed results also get a sidecar index (see index_path)
+    with the byte offset of every INDEX_STRIDE-th row, as [row, offset]
+    pairs, so read_rows() can seek to any row range without parsing what
+    comes before it.
+    """
+
+    def __init__(self, path, columns, compression=None, header=True, index=True):
+        self.path = path
+        self.compression = compression
+        self.index = index and compression is None
+        self.rows = 0
+        self.offsets = []
+        self._bytes = 0
+        # Unique, so concurrent writers of the same result never share a file
+        self._tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+        self._file = open_output(self._tmp_path, compression)
+        if header:
+            self._write(pd.DataFrame(columns=columns).to_csv(index=False).encode('utf-8'))
+
+    def _write(self, data):
+        self._file.write(data)
+        self._bytes += len(data)
+
+    def write(self, df):
+        """
+        Append the rows of a DataFrame (with the columns given at creation).
+        """
+        start = 0
+        while start < len(df):
+            # Pieces end on index strides, so every recorded offset starts a row
+            stop = min(len(df), start + INDEX_STRIDE - self.rows % INDEX_STRIDE)
+            if self.rows % INDEX_STRIDE == 0:
+                self.offsets.append([self.rows, self._bytes])
+            self._write(df.iloc[start:stop].to_csv(index=False, header=False).encode('utf-8'))
+            self.rows += stop - start
+            start = stop
+
+    def append(self, path, rows, offsets):
+        """
+        Append the rows of a CSV file written without header by another
+        writer, given its row count and offsets.
+        """
+        self.offsets.extend([self.rows + row, self._bytes + offset] for row, offset in offsets)
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(STREAM_BLOCK_SIZE)
+                if not block:
+                    break
+                self._write(block)
+        self.rows += rows
+
+    def close(self):
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+        index = index_path(self.path)
+        if self.index:
+            tmp_index = f"{index}.{uuid.uuid4().hex}.part"
+            with open(tmp_index, 'w', encoding='utf-8') as f:
+                json.dump({'rows': self.rows, 'bytes': self._bytes, 'offsets': self.offsets}, f)
+            os.replace(tmp_index, index)
+        elif os.path.exists(index):
+            os.remove(index)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_csv(df, path, compression=None):
+    """
+    Write a result DataFrame as CSV through a ChunkedCSVWriter. Returns the row count.
+    """
+    if len(df.columns) == 0:
+        # What to_csv writes for anjana's empty result
+        tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+        with open_output(tmp_path, compression) as f:
+            f.write(df.to_csv(index=False).encode('utf-8'))
+        os.replace(tmp_path, path)
+        return 0
+    with ChunkedCSVWriter(path, df.columns, compression) as writer:
+        writer.write(df)
+    return writer.rows
+
+
+def load_index(path):
+    """
+    Row index of a result written by ChunkedCSVWriter, or None if it has
+    none or it does not match the file any more.
+    """
+    try:
+        with open(index_path(path), encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if os.path.getsize(path) != index.get('bytes'):
+        return None
+    return index
+
+
+def read_rows(path, start, count):
+    """
+    Rows start to start + count of a CSV result, as the text stored in the
+    file, and the total number of rows (None if the result has no index).
+    Only the rows up to the end of the range are parsed, from the nearest
+    indexed offset when there is one.
+    """
+    columns = list(pd.read_csv(path, nrows=0).columns)
+    index = load_index(path)
+    options = dict(dtype=str, keep_default_na=False)
+    if index is None:
+        rows = pd.read_csv(path, nrows=start + count, **options).iloc[start:]
+        return rows, None
+    if start >= index['rows'] or not index['offsets']:
+        return pd.DataFrame(columns=columns), index['rows']
+    # Last indexed row at or before start
+    row, offset = index['offsets'][bisect.bisect_right([row for row, _ in index['offsets']], start) - 1]
+    skip = start - row
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        rows = pd.read_csv(f, header=None, names=columns, nrows=skip + count, **options).iloc[skip:]
+    return rows, index['rows']
+
+
+def stream_file(path, compression=None, block_size=STREAM_BLOCK_SIZE):
+    """
+    Yield the bytes of a file block by block, compressed on the fly with
+    gzip or zstd if asked, so a download starts before the file is read.
+    """
+    if compression == 'gzip':
+        compressor = zlib.compressobj(wbits=31)  # gzip container
+    elif compression is not None:
+        check_compression(compression)
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        compressor = None
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            if compressor is None:
+                yield block
+            else:
+                data = compressor.compress(block)
+                if data:
+                    yield data
+    if compressor is not None:
+        yield compressor.flush()